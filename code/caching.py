@@ -0,0 +1,370 @@
+''' caching.py keeps data about images across sessions so that it
+    doesn't have to be read from the image files every time. '''
+
+''' ...and this file is part of Pynorama.
+    
+    Pynorama is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    
+    Pynorama is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU General Public License for more details.
+    
+    You should have received a copy of the GNU General Public License
+    along with Pynorama. If not, see <http://www.gnu.org/licenses/>. '''
+
+import collections, hashlib, os, sqlite3, tempfile, threading, time, weakref
+from gi.repository import GLib
+
+class MetadataCache:
+	''' Stores the width and height of images in a SQLite database.
+	    Entries are keyed by uri and are only valid while the file size
+	    and modification time stay the same. This can be used from
+	    any thread, changes are committed a few seconds after being made '''
+	
+	# Seconds to wait before committing changes
+	CommitDelay = 5
+	
+	def __init__(self, path):
+		self.path = path
+		self._lock = threading.Lock()
+		self._connection = None
+		self._broken = False
+		self._commit_source = None
+		
+	def lookup(self, uri, data_size, mtime):
+		''' Returns the (width, height) stored for a file or None '''
+		with self._lock:
+			connection = self._connect()
+			if connection is None:
+				return None
+				
+			try:
+				row = connection.execute(
+				          "SELECT width, height FROM metadata "
+				          "WHERE uri = ? AND data_size = ? AND mtime = ?",
+				          (uri, data_size, mtime)).fetchone()
+				          
+			except sqlite3.Error:
+				return None
+				
+		return tuple(row) if row else None
+		
+	def store(self, uri, data_size, mtime, width, height):
+		''' Stores the size of an image file '''
+		with self._lock:
+			connection = self._connect()
+			if connection is None:
+				return
+				
+			try:
+				connection.execute(
+				          "INSERT OR REPLACE INTO metadata "
+				          "VALUES (?, ?, ?, ?, ?)",
+				          (uri, data_size, mtime, width, height))
+				          
+			except sqlite3.Error:
+				return
+				
+			if self._commit_source is None:
+				self._commit_source = GLib.timeout_add_seconds(
+				                          MetadataCache.CommitDelay,
+				                          self._delayed_commit)
+				                          
+	def commit(self):
+		''' Writes pending changes to the database right away '''
+		with self._lock:
+			if self._commit_source is not None:
+				GLib.source_remove(self._commit_source)
+				self._commit_source = None
+				
+			if self._connection is not None:
+				try:
+					self._connection.commit()
+					
+				except sqlite3.Error:
+					pass
+					
+	def _delayed_commit(self):
+		with self._lock:
+			self._commit_source = None
+			try:
+				self._connection.commit()
+				
+			except sqlite3.Error:
+				pass
+				
+		return False
+		
+	def _connect(self):
+		# The database is only opened when it's first needed and it
+		# isn't tried again if it can't be opened
+		if self._connection is None and not self._broken:
+			try:
+				os.makedirs(os.path.dirname(self.path), exist_ok=True)
+				connection = sqlite3.connect(self.path,
+				                             check_same_thread=False)
+				connection.execute("PRAGMA journal_mode = WAL")
+				connection.execute("PRAGMA synchronous = NORMAL")
+				connection.execute(
+				          "CREATE TABLE IF NOT EXISTS metadata ("
+				          "uri TEXT PRIMARY KEY, data_size INTEGER, "
+				          "mtime INTEGER, width INTEGER, height INTEGER)")
+				connection.commit()
+				
+			except (OSError, sqlite3.Error):
+				self._broken = True
+				
+			else:
+				self._connection = connection
+				
+		return self._connection
+
+MetadataCache.Default = MetadataCache(
+    os.path.join(GLib.get_user_cache_dir(), "pynorama", "metadata.sqlite"))
+
+class FileCache:
+	''' Keeps local copies of distant files in a directory.
+	    Copies are keyed by uri and only valid while the modification time
+	    of the copy matches the one of the distant file. The least recently
+	    used copies are deleted when the copies take more than "limit" bytes.
+	    This can be used from any thread. '''
+	
+	def __init__(self, directory, limit=1024 * 1024 * 1024):
+		self.directory = directory
+		self.limit = limit
+		self._lock = threading.Lock()
+		# Maps paths of copies to their size, least recently used first
+		self._copies = None
+		self._usage = 0
+		
+	def get_path(self, uri):
+		''' Returns the path for the copy of an uri '''
+		name = hashlib.md5(uri.encode("utf-8")).hexdigest()
+		return os.path.join(self.directory, name)
+		
+	def lookup(self, uri, mtime):
+		''' Returns the path of an up to date copy of an uri or None '''
+		path = self.get_path(uri)
+		with self._lock:
+			self._scan()
+			if path not in self._copies:
+				return None
+				
+			try:
+				if int(os.stat(path).st_mtime) == int(mtime):
+					self._copies.move_to_end(path)
+					return path
+					
+			except OSError:
+				self._usage -= self._copies.pop(path)
+				
+		return None
+		
+	def create_temp_path(self):
+		''' Returns a new path to copy a distant file into '''
+		with self._lock:
+			os.makedirs(self.directory, mode=0o700, exist_ok=True)
+			
+		handle, temp_path = tempfile.mkstemp(suffix=".part",
+		                                     dir=self.directory)
+		os.close(handle)
+		return temp_path
+		
+	def add(self, uri, mtime, temp_path):
+		''' Moves a complete copy of an uri into the cache, deleting
+		    older copies if necessary. Returns its new path '''
+		path = self.get_path(uri)
+		os.utime(temp_path, (time.time(), mtime))
+		size = os.stat(temp_path).st_size
+		with self._lock:
+			self._scan()
+			os.replace(temp_path, path)
+			self._usage -= self._copies.pop(path, 0)
+			self._copies[path] = size
+			self._usage += size
+			
+			# The newest copy is kept even if it's too big by itself
+			while self._usage > self.limit and len(self._copies) > 1:
+				old_path, old_size = self._copies.popitem(last=False)
+				self._usage -= old_size
+				try:
+					os.remove(old_path)
+					
+				except OSError:
+					pass
+					
+		return path
+		
+	def _scan(self):
+		# Finds copies from previous sessions, oldest accessed first
+		if self._copies is None:
+			self._copies = collections.OrderedDict()
+			found_copies = []
+			try:
+				for a_name in os.listdir(self.directory):
+					a_path = os.path.join(self.directory, a_name)
+					if a_name.endswith(".part"):
+						# Leftovers of interrupted transfers
+						os.remove(a_path)
+						
+					else:
+						a_stat = os.stat(a_path)
+						found_copies.append((a_stat.st_atime, a_path,
+						                     a_stat.st_size))
+						                     
+			except OSError:
+				pass
+				
+			for an_atime, a_path, a_size in sorted(found_copies):
+				self._copies[a_path] = a_size
+				self._usage += a_size
+
+FileCache.Default = FileCache(
+    os.path.join(GLib.get_user_cache_dir(), "pynorama", "files"))
+
+''' The size, a hash of sampled blocks and the identity of a file '''
+Content = collections.namedtuple("Content", ["path", "size", "mtime",
+                                             "device", "inode", "samples"])
+
+class ContentIndex:
+	''' Finds things made from files with the same content, like copies or
+	    hardlinks of the same picture, so that they can share what was
+	    decoded from them. Files are told apart by their size and a hash of
+	    a few sampled blocks, and files that match are only confirmed to be
+	    the same by a hash of their whole content, unless they are the same
+	    file. This can be used from any thread '''
+	
+	# Bytes in each sampled block and the number of blocks sampled
+	SampleSize = 64 * 1024
+	SampleCount = 4
+	
+	def __init__(self):
+		self.enabled = True
+		self._lock = threading.Lock()
+		# Maps (size, samples) pairs to the things with that content
+		self._things = {}
+		self._thing_keys = weakref.WeakKeyDictionary()
+		# Hashes of the files of the things, by device, inode, size and mtime
+		self._digests = {}
+		
+	def identify(self, path):
+		''' Returns the Content of a file, which is cheap to compute '''
+		with open(path, "rb") as a_file:
+			a_stat = os.fstat(a_file.fileno())
+			size = a_stat.st_size
+			sample_size = ContentIndex.SampleSize
+			sample_count = ContentIndex.SampleCount
+			digest = hashlib.sha1()
+			if size <= sample_size * sample_count:
+				digest.update(a_file.read())
+				
+			else:
+				step = (size - sample_size) // (sample_count - 1)
+				for i in range(sample_count):
+					a_file.seek(i * step)
+					digest.update(a_file.read(sample_size))
+					
+		return Content(path, size, a_stat.st_mtime, a_stat.st_dev,
+		               a_stat.st_ino, digest.hexdigest())
+		
+	def add(self, content, thing):
+		''' Records that a thing was made from a file with some content.
+		    Things are only referenced weakly '''
+		key = content.size, content.samples
+		with self._lock:
+			if self._thing_keys.get(thing) != key:
+				self._forget(thing)
+				
+			some_things = self._things.get(key)
+			if some_things is None:
+				some_things = self._things[key] = weakref.WeakKeyDictionary()
+				
+			some_things[thing] = content
+			self._thing_keys[thing] = key
+			
+	def remove(self, thing):
+		''' Forgets a thing, along with the hash of its file unless
+		    other things were made from the same file '''
+		with self._lock:
+			self._forget(thing)
+			
+	def _forget(self, thing):
+		key = self._thing_keys.pop(thing, None)
+		some_things = self._things.get(key)
+		if some_things is None:
+			return
+			
+		content = some_things.pop(thing, None)
+		if not some_things:
+			del self._things[key]
+			
+		if content is not None:
+			# Files with the same identity have the same size and samples
+			digest_key = ContentIndex._GetDigestKey(content)
+			if not any(ContentIndex._GetDigestKey(other) == digest_key
+			           for other in some_things.values()):
+				self._digests.pop(digest_key, None)
+				
+	@staticmethod
+	def _GetDigestKey(content):
+		return content.device, content.inode, content.size, content.mtime
+		
+	def find(self, content, accept):
+		''' Returns the first result of accept(thing) that isn't None for
+		    things added with the same content, or None. Whole files are
+		    only hashed to confirm things accept returned something for '''
+		key = content.size, content.samples
+		with self._lock:
+			some_things = self._things.get(key)
+			candidates = list(some_things.items()) if some_things else []
+			
+		for a_thing, its_content in candidates:
+			result = accept(a_thing)
+			if result is not None and self._is_same(content, its_content):
+				return result
+				
+		return None
+		
+	def _is_same(self, content, other_content):
+		if (content.device, content.inode) == \
+		   (other_content.device, other_content.inode):
+			return True # Hardlinks, symlinks or the very same file
+			
+		if content.size <= ContentIndex.SampleSize * ContentIndex.SampleCount:
+			return True # The samples were the whole file
+			
+		try:
+			return self._get_digest(content) == \
+			       self._get_digest(other_content)
+			
+		except OSError:
+			return False
+			
+	def _get_digest(self, content):
+		key = ContentIndex._GetDigestKey(content)
+		with self._lock:
+			result = self._digests.get(key)
+			
+		if result is None:
+			digest = hashlib.sha1()
+			with open(content.path, "rb") as a_file:
+				for a_block in iter(lambda: a_file.read(1024 * 1024), b""):
+					digest.update(a_block)
+					
+			result = digest.hexdigest()
+			with self._lock:
+				# Only hashes of files things were made from are kept
+				some_things = self._things.get((content.size,
+				                                content.samples))
+				if some_things and any(
+				       ContentIndex._GetDigestKey(other) == key
+				       for other in some_things.values()):
+					self._digests[key] = result
+				
+		return result
+
+ContentIndex.Default = ContentIndex()
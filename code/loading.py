@@ -16,12 +16,15 @@
     You should have received a copy of the GNU General Public License
     along with Pynorama. If not, see <http://www.gnu.org/licenses/>. '''
 
-import os, re, datetime, time
+import math, os, re, datetime, time, urllib.parse
+import collections, threading, weakref
+import io, posixpath, tarfile, zipfile
 
 from gi.repository import Gdk, GdkPixbuf, Gio, GObject, GLib, Gtk
 from gettext import gettext as _
 import cairo
 import sys
+import tasking
 
 LoaderList = []
 
@@ -40,6 +43,7 @@ class CombinedDialogOption:
 		
 		result.set_name(self.name)
 		for an_option in self.options:
+			an_option.prepare()
 			for a_pattern in an_option.patterns:
 				result.add_pattern(a_pattern)
 			
@@ -57,8 +61,16 @@ class DialogOption:
 		self.patterns = patterns
 		self.mime_types = mime_types
 		
+	def prepare(self):
+		''' Sets up the loader if it fills in the patterns
+		    and mime types only when they are needed '''
+		setup = getattr(self.loader, "setup", None)
+		if setup:
+			setup()
+			
 	def create_filter(self):
 		''' Creates a Gtk.FileFilter for this option '''
+		self.prepare()
 		result = Gtk.FileFilter()
 		result.dialog_option = self
 		
@@ -77,6 +89,7 @@ class Context:
 	    by other loaders or uris and also report problems with this class. '''
 	
 	BasicFileInfo = ("standard::name," +
+	                 "standard::display-name," +
 	                 "standard::type," +
 	                 "standard::content-type")
 	
@@ -100,8 +113,39 @@ class Context:
 			except Exception as a_problem:
 				self.problems[a_file] = a_problem
 	
+	def load_files_info_async(self, callback, *data):
+		''' Loads the info of all files without blocking and then
+		    calls callback(context, *data) from the main loop '''
+		tasking.Task(self._load_files_info(callback, data))
+		
+	def _load_files_info(self, callback, data):
+		pending_files = [a_file for a_file in self.files \
+		                        if not hasattr(a_file, "info")]
+		queries = [tasking.Wrap(a_file.query_info_async,
+		                        a_file.query_info_finish,
+		                        Context.BasicFileInfo,
+		                        Gio.FileQueryInfoFlags.NONE,
+		                        GLib.PRIORITY_DEFAULT)
+		           for a_file in pending_files]
+		results = yield from tasking.Gather(*queries, return_errors=True)
+		for a_file, a_result in zip(pending_files, results):
+			if isinstance(a_result, Exception):
+				self.problems[a_file] = a_result
+				
+			else:
+				a_file.info = a_result
+				
+		callback(self, *data)
+	
 	def add_sibling_files(self, loader):
 		Context.AddSiblingFiles(self, loader, self.files)
+		
+	def add_sibling_files_async(self, loader, callback):
+		''' Like add_sibling_files, but lists the parent directories without
+		    blocking. callback(context, new_files, finished) is called for
+		    every batch of siblings found, which are not added to the
+		    context files, and finished is True the last time '''
+		Context.AddSiblingFilesAsync(self, loader, self.files, callback)
 	
 	@staticmethod
 	def LoadFileInfo(gfile):
@@ -149,26 +193,178 @@ class Context:
 		new_files = [a_file for a_file in siblings \
 		                        if loader.should_open(a_file)]
 		context.files.extend(new_files)
+		
+	@staticmethod
+	def AddSiblingFilesAsync(context, loader, gfiles, callback):
+		''' Streams files that loader should open and are children of
+		    gfiles parents into callback(context, new_files, finished) '''
+		gfiles = list(gfiles)
+		parent_files = []
+		for a_gfile in gfiles:
+			a_parent_file = a_gfile.get_parent()
+			if a_parent_file and not any(a_parent_file.equal(a_known_file)
+			                             for a_known_file in parent_files):
+				parent_files.append(a_parent_file)
+				
+		pending_parents = [len(parent_files)]
+		def siblings_listed(listing_context, some_files, finished):
+			new_files = []
+			for a_sibling in some_files:
+				# Only add children files that do not equal an input file #
+				for a_gfile in gfiles:
+					if a_gfile.equal(a_sibling):
+						break
+				else:
+					if loader.should_open(a_sibling):
+						new_files.append(a_sibling)
+						
+			if finished:
+				pending_parents[0] -= 1
+				
+			callback(context, new_files, not pending_parents[0])
+			
+		if parent_files:
+			for a_parent_file in parent_files:
+				DirectoryLoader.open_file_async(Context(), a_parent_file,
+				                                siblings_listed)
+		else:
+			callback(context, [], True)
+
+def OpenFile(loader, context, gfile):
+	''' Returns a tasking.Future for opening a file with a loader.
+	    Loaders can have an async_open_file(context, gfile) method that
+	    returns a coroutine or future instead of a blocking open_file
+	    method, which is run right away for loaders that don't '''
+	async_open_file = getattr(loader, "async_open_file", None)
+	if async_open_file is not None:
+		return tasking.Ensure(async_open_file(context, gfile))
+		
+	future = tasking.Future()
+	try:
+		loader.open_file(context, gfile)
+		
+	except Exception as a_problem:
+		future.set_error(a_problem)
+		
+	else:
+		future.set_result(None)
+		
+	return future
+	
+def OpenFiles(loader, context, gfiles):
+	''' Opens several files at once with a loader, so that loaders that
+	    wait for I/O wait for every file at the same time. What is opened
+	    is added to the context in the order of gfiles and errors are
+	    added to its problems. Returns a tasking.Task for the context '''
+	def open_files():
+		file_contexts = [Context() for a_file in gfiles]
+		results = yield from tasking.Gather(
+		              *[OpenFile(loader, a_context, a_file)
+		                for a_context, a_file in zip(file_contexts, gfiles)],
+		              return_errors=True)
+		                
+		for a_file, a_context, a_result in zip(gfiles, file_contexts, results):
+			if isinstance(a_result, Exception):
+				context.problems[a_file] = a_result
+				
+			context.images.extend(a_context.images)
+			context.files.extend(a_context.files)
+			context.uris.extend(a_context.uris)
+			context.problems.update(a_context.problems)
+			
+		return context
+		
+	return tasking.Task(open_files())
+	
+def GetFileSuffix(gfile):
+	''' Returns the lowercase extension of a file, including the dot '''
+	return os.path.splitext(gfile.get_basename() or "")[1].lower()
 
 class LoadersLoader:
-	''' This loader will dispatch calls to loaders in a list passed to it '''
+	''' This loader will dispatch calls to loaders in a list passed to it.
+	    Loaders with "Extensions" and "MimeTypes" sets are looked up by
+	    the file extension and content type instead of being asked
+	    whether they should open a file, the other ones are asked.
+	    Loaders with a "setup" method have it called before that '''
 	def __init__(self, loaders, reversed_open=False):
 		self.loaders = loaders
 		self.reversed_open = reversed_open
 		
+		self._indexed_loaders = None
+		self._suffix_index = {}
+		self._mime_index = {}
+		self._unindexed_loaders = []
+		
 	def should_open(self, gfile):
-		return any((a_loader.should_open(gfile) for a_loader in self.loaders))
+		return self.find_loader(gfile) is not None
 		
 	def open_file(self, context, gfile):
+		a_loader = self.find_loader(gfile)
+		if a_loader:
+			a_loader.open_file(context, gfile)
+			
+	def async_open_file(self, context, gfile):
+		''' Returns a tasking.Future for opening a file with the loader
+		    that should open it, see OpenFile '''
+		a_loader = self.find_loader(gfile)
+		if a_loader:
+			return OpenFile(a_loader, context, gfile)
+			
+		else:
+			future = tasking.Future()
+			future.set_result(None)
+			return future
+			
+	def find_loader(self, gfile):
+		''' Returns the loader that should open a file or None '''
+		if self._indexed_loaders != self.loaders:
+			self._build_index()
+			
+		a_loader = self._suffix_index.get(GetFileSuffix(gfile))
+		if a_loader is None:
+			info = getattr(gfile, "info", None)
+			if info and info.has_attribute("standard::content-type"):
+				a_loader = self._mime_index.get(info.get_content_type())
+				
+		if a_loader is None:
+			for an_unindexed_loader in self._unindexed_loaders:
+				if an_unindexed_loader.should_open(gfile):
+					return an_unindexed_loader
+					
+		return a_loader
+		
+	def _build_index(self):
+		# The first loader in opening order wins
 		loaders = reversed(self.loaders) if self.reversed_open else self.loaders
 		
+		self._suffix_index.clear()
+		self._mime_index.clear()
+		del self._unindexed_loaders[:]
 		for a_loader in loaders:
-			if a_loader.should_open(gfile):
-				a_loader.open_file(context, gfile)
-				break
+			setup = getattr(a_loader, "setup", None)
+			if setup:
+				setup()
+				
+			extensions = getattr(a_loader, "Extensions", None)
+			mime_types = getattr(a_loader, "MimeTypes", None)
+			if extensions is None or mime_types is None:
+				self._unindexed_loaders.append(a_loader)
 				
+			else:
+				for an_extension in extensions:
+					self._suffix_index.setdefault(an_extension, a_loader)
+					
+				for a_mime_type in mime_types:
+					self._mime_index.setdefault(a_mime_type, a_loader)
+					
+		self._indexed_loaders = list(self.loaders)
+		
 class DirectoryLoader:
 	''' A directory loader. Returns files in a directory. '''
+	# Batches start small so that the first files show up right away
+	FirstBatchSize = 32
+	BatchSize = 256
+	
 	@classmethod
 	def should_open(cls, gfile):
 		Context.LoadFileInfo(gfile)
@@ -187,15 +383,130 @@ class DirectoryLoader:
 			except Exception:
 				raise
 				
+	@classmethod
+	def open_file_async(cls, context, gfile, callback, cancellable=None):
+		''' Lists the files in a directory without blocking.
+		    callback(context, some_files, finished) is called from the
+		    main loop with batches of child files as they are found,
+		    finished is True for the last batch, which is also delivered
+		    if the listing is cancelled. Subdirectories are skipped
+		    and errors are added to the context problems '''
+		cancellable = cancellable or Gio.Cancellable()
+		path = gfile.get_path() if gfile.is_native() else None
+		# Directory iterators are only closed by "with" since Python 3.6
+		if path and sys.version_info >= (3, 6):
+			# Listing native directories in a thread avoids creating
+			# a GFileInfo for every entry
+			a_thread = threading.Thread(target=cls._scan_directory,
+			                            args=(context, gfile, path,
+			                                  callback, cancellable),
+			                            name="pynorama-directory-scanner")
+			a_thread.daemon = True
+			a_thread.start()
+			
+		else:
+			tasking.Task(cls._enumerate(context, gfile, callback,
+			                            cancellable), cancellable)
+			
+	@classmethod
+	def _scan_directory(cls, context, gfile, path, callback, cancellable):
+		deliver = lambda files, finished: GLib.idle_add(
+		                 cls._deliver_files, context, files, finished, callback)
+		
+		batch, batch_size = [], cls.FirstBatchSize
+		try:
+			with os.scandir(path) as entries:
+				for an_entry in entries:
+					if cancellable.is_cancelled():
+						batch = []
+						break
+						
+					try:
+						if an_entry.is_dir():
+							continue
+							
+					except OSError:
+						pass
+						
+					batch.append(Gio.File.new_for_path(an_entry.path))
+					if len(batch) >= batch_size:
+						deliver(batch, False)
+						batch, batch_size = [], cls.BatchSize
+						
+		except OSError as an_error:
+			GLib.idle_add(cls._add_problem, context, gfile, an_error)
+			
+		deliver(batch, True)
+		
+	@staticmethod
+	def _deliver_files(context, some_files, finished, callback):
+		callback(context, some_files, finished)
+		return False
+		
+	@staticmethod
+	def _add_problem(context, gfile, a_problem):
+		context.problems[gfile] = a_problem
+		return False
+		
+	@classmethod
+	def _enumerate(cls, context, gfile, callback, cancellable):
+		# Lists directories that are not native with GIO, runs as a task.
+		# The last batch is delivered even if it fails or is cancelled
+		enumerator = None
+		try:
+			enumerator = yield from tasking.Wrap(
+			      gfile.enumerate_children_async,
+			      gfile.enumerate_children_finish,
+			      "standard::name,standard::display-name,standard::type",
+			      0, GLib.PRIORITY_DEFAULT, cancellable=cancellable)
+			      
+			batch_size = cls.FirstBatchSize
+			while True:
+				some_infos = yield from tasking.Wrap(
+				                   enumerator.next_files_async,
+				                   enumerator.next_files_finish,
+				                   batch_size, GLib.PRIORITY_DEFAULT,
+				                   cancellable=cancellable)
+				if not some_infos:
+					break
+					
+				some_files = []
+				for a_file_info in some_infos:
+					if a_file_info.get_file_type() != Gio.FileType.DIRECTORY:
+						a_child_file = gfile.get_child(a_file_info.get_name())
+						a_child_file.info = a_file_info
+						some_files.append(a_child_file)
+						
+				callback(context, some_files, False)
+				batch_size = cls.BatchSize
+				
+		except tasking.Cancelled:
+			raise
+			
+		except Exception as a_problem:
+			# Operations stopped by the cancellable are not problems
+			if not cancellable.is_cancelled():
+				context.problems[gfile] = a_problem
+				
+		finally:
+			if enumerator is not None:
+				enumerator.close_async(GLib.PRIORITY_DEFAULT, None, None, None)
+				
+			callback(context, [], True)
+		
 class PixbufFileLoader:
-	''' A GdkPixbuf file loader. Should load images supported by GdkPixbuf '''
+	''' A GdkPixbuf file loader. Should load images supported by GdkPixbuf.
+	    The supported formats are only looked up when they are first needed,
+	    since that reads the information of every GdkPixbuf module '''
 	Options = []
-	Extensions = tuple()
+	Extensions = frozenset()
+	MimeTypes = frozenset()
+	_SetUp = False
 	
 	@classmethod
 	def should_open(cls, gfile):
-		uri = gfile.get_uri()
-		return uri.endswith(PixbufFileLoader.Extensions)
+		PixbufFileLoader.setup()
+		return GetFileSuffix(gfile) in PixbufFileLoader.Extensions
 		
 	@classmethod
 	def open_file(cls, context, gfile):
@@ -209,8 +520,12 @@ class PixbufFileLoader:
 			context.images.append(new_image)
 	
 	@staticmethod
-	def _setup():
-		# Create dialog options for PixbufFileLoader
+	def setup():
+		''' Finds out the formats supported by GdkPixbuf, once '''
+		if PixbufFileLoader._SetUp:
+			return
+			
+		PixbufFileLoader._SetUp = True
 		_formats = GdkPixbuf.Pixbuf.get_formats()
 		_mime_types = set()
 		_patterns = set()
@@ -223,20 +538,23 @@ class PixbufFileLoader:
 	
 			for an_extension in a_format.get_extensions():
 				_patterns.add("*." + an_extension)
-				_extensions.add("." + an_extension)
+				_extensions.add("." + an_extension.lower())
 		
-		PixbufFileLoader.Extensions = tuple(_extensions)		
-		PixbufFileLoader.DialogOption = DialogOption(
-		                                PixbufFileLoader, _("Pixbuf Images"),
-		                                _patterns, _mime_types)
-		                                
+		PixbufFileLoader.Extensions = frozenset(_extensions)
+		PixbufFileLoader.MimeTypes = frozenset(_mime_types)
+		PixbufFileLoader.DialogOption.patterns = _patterns
+		PixbufFileLoader.DialogOption.mime_types = _mime_types
+		
+PixbufFileLoader.DialogOption = DialogOption(PixbufFileLoader,
+                                             _("Pixbuf Images"))
+                                             
 class PixbufAnimationFileLoader:
-	Extensions = (".gif")
+	Extensions = frozenset([".gif"])
+	MimeTypes = frozenset(["image/gif"])
 	
 	@classmethod
 	def should_open(cls, gfile):
-		uri = gfile.get_uri()
-		return uri.endswith(PixbufAnimationFileLoader.Extensions)
+		return GetFileSuffix(gfile) in PixbufAnimationFileLoader.Extensions
 		
 	@classmethod
 	def open_file(cls, context, gfile):
@@ -252,6 +570,53 @@ class PixbufAnimationFileLoader:
 PixbufAnimationFileLoader.DialogOption = DialogOption(PixbufAnimationFileLoader,
                                                       _("Pixbuf Animations"),
                                                       ["*.gif"], ["image/gif"])
+
+class ArchiveLoader:
+	''' Opens the images in zip and tar archives, like comic book archives,
+	    without extracting them. Only the list of members is read when
+	    opening, in a worker thread, members are read when their images
+	    are loaded. Archives are only expanded when they are opened
+	    themselves, through async_open_file, not when they are found
+	    in a directory or next to other files '''
+	Extensions = frozenset([".zip", ".cbz", ".tar", ".cbt"])
+	MimeTypes = frozenset(["application/zip", "application/x-cbz",
+	                       "application/vnd.comicbook+zip",
+	                       "application/x-tar", "application/x-cbt"])
+	
+	@classmethod
+	def should_open(cls, gfile):
+		return GetFileSuffix(gfile) in ArchiveLoader.Extensions
+		
+	@classmethod
+	def open_file(cls, context, gfile):
+		pass # Archives found among other files are left alone
+		
+	@classmethod
+	def async_open_file(cls, context, gfile):
+		archive = Archive(gfile)
+		try:
+			members = yield from DecodingEngine.Default.run(
+			                         lambda job: archive.list_members())
+			                         
+		except tasking.Cancelled:
+			raise
+			
+		except Exception as a_problem:
+			context.problems[gfile] = a_problem
+			return
+			
+		PixbufFileLoader.setup()
+		image_extensions = PixbufFileLoader.Extensions | \
+		                   PixbufAnimationFileLoader.Extensions
+		for a_member in members:
+			suffix = posixpath.splitext(a_member.name)[1].lower()
+			if suffix in image_extensions:
+				new_image = ArchiveMemberImageNode(archive, a_member)
+				context.images.append(new_image)
+
+ArchiveLoader.DialogOption = DialogOption(ArchiveLoader, _("Image Archives"),
+                                          ["*.zip", "*.cbz", "*.tar", "*.cbt"],
+                                          sorted(ArchiveLoader.MimeTypes))
                                                       
 LoadersLoader.LoaderListLoader = LoadersLoader(LoaderList, reversed_open=True)
 SupportedFilesOption = CombinedDialogOption(LoadersLoader.LoaderListLoader,
@@ -260,13 +625,13 @@ SupportedFilesOption = CombinedDialogOption(LoadersLoader.LoaderListLoader,
                                             
 CombinedDialogOption.List.append(SupportedFilesOption)
 
-PixbufFileLoader._setup()
-
 LoaderList.append(PixbufFileLoader)
 LoaderList.append(PixbufAnimationFileLoader)
+LoaderList.append(ArchiveLoader)
 
 DialogOption.List.append(PixbufFileLoader.DialogOption)
 DialogOption.List.append(PixbufAnimationFileLoader.DialogOption)
+DialogOption.List.append(ArchiveLoader.DialogOption)
 
 class DataError(Exception):
 	''' For exceptions due to the current state of the data loaded '''
@@ -296,6 +661,9 @@ class Loadable(GObject.GObject):
 		
 		self.location = Location.Nowhere
 		self.status = Status.Bad
+		# The Memory that observes this, see Memory.observe
+		self.memory = None
+		self._uses = self._lists = self._priority = 0
 		
 	def load(self):
 		raise NotImplementedError
@@ -303,8 +671,83 @@ class Loadable(GObject.GObject):
 	def unload(self):
 		raise NotImplementedError
 		
-	uses = GObject.property(type=int, default=0)
-	lists = GObject.property(type=int, default=0)
+	def async_load(self):
+		''' Returns a tasking.Future for the thing that is done once it is
+		    loaded, loading it if it isn't loaded or loading already.
+		    This skips the memory management, which is better left
+		    to decide what gets loaded unless the thing is needed now.
+		    A use is held until the callbacks of the future and the
+		    coroutines waiting for it had their turn, so the memory does
+		    not unload it in the meanwhile. Keep a use to keep it loaded '''
+		future = tasking.Future()
+		if self.on_memory and not self.is_loading:
+			future.set_result(self)
+			return future
+			
+		def finished_loading(thing, error):
+			thing.disconnect(handler_id)
+			if error:
+				future.set_error(error)
+				
+			else:
+				future.set_result(thing)
+				
+			thing.uses -= 1
+			
+		handler_id = self.connect("finished-loading", finished_loading)
+		self.uses += 1
+		if not self.is_loading:
+			self.load()
+			
+		return future
+		
+	# Changes are passed on to these methods and to the memory instead of
+	# connecting every thing to its notify signals, which adds up to a lot
+	# of memory and time when opening thousands of things
+	def _uses_changed(self):
+		if self.memory is not None:
+			self.memory._uses_changed(self)
+			
+	def _lists_changed(self):
+		if self.memory is not None:
+			self.memory._lists_changed(self)
+			
+	def _priority_changed(self):
+		pass
+		
+	def do_finished_loading(self, error):
+		if self.memory is not None:
+			self.memory._finished_loading(self, error)
+			
+	# These are plain python properties, reading them from the memory
+	# checks goes through no GObject machinery
+	@property
+	def uses(self):
+		return self._uses
+		
+	@uses.setter
+	def uses(self, value):
+		self._uses = value
+		self._uses_changed()
+		
+	@property
+	def lists(self):
+		return self._lists
+		
+	@lists.setter
+	def lists(self, value):
+		self._lists = value
+		self._lists_changed()
+		
+	@property
+	def priority(self):
+		''' Things with a lower priority are loaded first '''
+		return self._priority
+		
+	@priority.setter
+	def priority(self, value):
+		self._priority = value
+		self._priority_changed()
 	
 	@property
 	def on_memory(self):
@@ -316,19 +759,29 @@ class Loadable(GObject.GObject):
 			
 	@property
 	def is_loading(self):
-		return self.status == Status.Loading
+		return self.status in (Status.Caching, Status.Loading)
+		
+	@property
+	def is_caching(self):
+		return self.status == Status.Caching
 		
 	@property
 	def is_bad(self):
 		return self.status == Status.Bad
 		
 class Memory(GObject.GObject):
-	''' A very basic memory management thing '''
+	''' A very basic memory management thing.
+	    Loaded things that are no longer used are kept in an inactive tier
+	    and only unloaded, least recently used first, when the memory used
+	    by all loaded things goes over the budget. '''
 	__gsignals__ = {
 		"thing-enlisted": (GObject.SIGNAL_RUN_FIRST, None, (Loadable,)),
 		"thing-requested": (GObject.SIGNAL_RUN_FIRST, None, (Loadable,)),
 		"thing-unused": (GObject.SIGNAL_RUN_FIRST, None, (Loadable,)),
 		"thing-unlisted": (GObject.SIGNAL_RUN_FIRST, None, (Loadable,)),
+		"thing-loaded": (GObject.SIGNAL_RUN_FIRST, None, (Loadable,)),
+		"thing-finished": (GObject.SIGNAL_RUN_FIRST, None,
+		                   (Loadable, object)),
 	}
 	
 	def __init__(self):
@@ -338,11 +791,75 @@ class Memory(GObject.GObject):
 		self.unused_stuff = set()
 		self.enlisted_stuff = set()
 		self.unlisted_stuff = set()
+		
+		self.loaded_stuff = set()
+		# Used as an ordered set, least recently used things come first
+		self.inactive_stuff = collections.OrderedDict()
 	
 	def observe(self, thing):
-		''' Start generating events for a thing  '''
-		thing.connect("notify::uses", self._uses_changed)
-		thing.connect("notify::lists", self._lists_changed)
+		''' Start generating events for a thing. Things that create
+		    previews later on have them observed by thing.memory '''
+		thing.memory = self
+		
+		preview = getattr(thing, "preview", None)
+		if preview:
+			self.observe(preview)
+		
+	def deactivate(self, thing):
+		''' Keeps a loaded thing around in case it is used again '''
+		self.inactive_stuff.pop(thing, None)
+		self.inactive_stuff[thing] = None
+		
+	def activate(self, thing):
+		''' Takes a thing out of the inactive tier '''
+		self.inactive_stuff.pop(thing, None)
+		
+	def unload(self, thing):
+		''' Unloads or cancels loading a thing.
+		    Returns whether there was anything to unload '''
+		self.loaded_stuff.discard(thing)
+		self.inactive_stuff.pop(thing, None)
+		if thing.is_loading or thing.on_memory:
+			thing.unload()
+			return True
+			
+		else:
+			return False
+			
+	def get_usage(self):
+		''' Returns the number of bytes used by loaded things '''
+		return sum(a_thing.get_memory_size() for a_thing in self.loaded_stuff)
+		
+	def collect(self):
+		''' Unloads inactive things until the loaded things fit in the
+		    budget and returns a list of the things unloaded '''
+		self.loaded_stuff = {a_thing for a_thing in self.loaded_stuff
+		                             if a_thing.on_memory}
+		for a_thing in list(self.inactive_stuff):
+			if not a_thing.on_memory:
+				del self.inactive_stuff[a_thing]
+				
+		result = []
+		usage = self.get_usage()
+		while usage > self.budget and self.inactive_stuff:
+			a_thing = self.inactive_stuff.popitem(last=False)[0]
+			usage -= a_thing.get_memory_size()
+			self.unload(a_thing)
+			result.append(a_thing)
+			
+		return result
+		
+	''' Maximum number of bytes loaded things should use '''
+	budget = GObject.property(type=GObject.TYPE_INT64,
+	                          default=256 * 1024 * 1024)
+	
+	def _finished_loading(self, thing, error):
+		if thing.on_memory:
+			self.loaded_stuff.add(thing)
+			self.emit("thing-loaded", thing)
+			
+		self.emit("thing-finished", thing, error)
+			
 	
 	def _uses_changed(self, thing, *data):
 		if thing.uses == 1:
@@ -373,7 +890,206 @@ class Memory(GObject.GObject):
 			else:
 				self.unlisted_stuff.add(thing)
 				self.emit("thing-unlisted", thing)
+
+class DecodingJob:
+	''' A piece of work for a DecodingEngine.
+	    "work" is called in a worker thread with the job as argument and
+	    its return value is stored in "result". Then "callback" is called
+	    in the main loop, also with the job as argument.
+	    Queued jobs with a lower priority are started first and the
+	    priority can be changed until the job is started.
+	    Engines can limit how many jobs of the same group run at once. '''
+	
+	def __init__(self, work, callback, cancellable=None, priority=0,
+	             group=None):
+		self.work = work
+		self.callback = callback
+		self.cancellable = cancellable or Gio.Cancellable()
+		self.priority = priority
+		self.group = group
+		
+		self.result = None
+		self.error = None
+		# Work functions should set this to the number of bytes they read
+		self.size = 0
+		
+	def cancel(self):
+		self.cancellable.cancel()
+		
+	@property
+	def cancelled(self):
+		return self.cancellable.is_cancelled()
+
+class DecodingEngine(GObject.GObject):
+	''' Runs decoding jobs in a bounded pool of worker threads.
+	    The number of jobs running at once is adapted between one and the
+	    worker count depending on the throughput measured, so that slow
+	    network mounts are not flooded with concurrent reads. '''
+	
+	# Number of jobs finished between every throughput measurement
+	SampleSize = 8
+	
+	def __init__(self, workers=0):
+		GObject.GObject.__init__(self)
+		
+		self._condition = threading.Condition()
+		self._jobs = collections.deque()
+		self._threads = []
+		self._running = 0
+		self._running_groups = collections.Counter()
+		# Maximum number of jobs of a group running at once, zero is no limit
+		self.group_limit = 0
+		
+		self.connect("notify::workers", self._workers_changed)
+		
+		# Start with every worker busy and step back if that is worse
+		self._parallelism = None
+		self._direction = -1
+		self._last_throughput = None
+		self._sample_bytes = 0
+		self._sample_count = 0
+		self._sample_start = None
+		
+		self.workers = workers
+		
+	def submit(self, work, callback, cancellable=None, priority=0,
+	           group=None):
+		''' Queues work to be done in a worker thread, returns a DecodingJob '''
+		job = DecodingJob(work, callback, cancellable, priority, group)
+		with self._condition:
+			self._jobs.append(job)
+			self._spawn_threads()
+			self._condition.notify()
+			
+		return job
+		
+	def run(self, work, cancellable=None, priority=0, group=None):
+		''' Like submit, but returns a tasking.Future for what work returns
+		    instead of calling back. Cancelling the future cancels the job '''
+		future = tasking.Future(cancellable)
+		def finished(job):
+			if job.error:
+				future.set_error(job.error)
+				
+			else:
+				future.set_result(job.result)
+				
+		self.submit(work, finished, future.cancellable, priority, group)
+		return future
+		
+	def get_worker_limit(self):
+		''' Returns the maximum number of worker threads '''
+		return self.workers if self.workers > 0 else (os.cpu_count() or 2)
+		
+	''' Maximum number of worker threads, zero means one per processor '''
+	workers = GObject.property(type=int, default=0)
+	
+	def _workers_changed(self, *data):
+		with self._condition:
+			limit = self.get_worker_limit()
+			if self._parallelism is None or self._parallelism > limit:
+				self._parallelism = limit
+				
+			self._condition.notify_all()
+			
+	def _spawn_threads(self):
+		# Threads are only started when there is work to do
+		limit = self.get_worker_limit()
+		while len(self._threads) < min(limit, self._running + len(self._jobs)):
+			a_thread = threading.Thread(target=self._work_loop,
+			                            name="pynorama-decoder")
+			a_thread.daemon = True
+			self._threads.append(a_thread)
+			a_thread.start()
+			
+	def _next_job(self):
+		''' Waits for a job, returns None if the thread should quit '''
+		with self._condition:
+			while True:
+				me = threading.current_thread()
+				if self._threads.index(me) >= self.get_worker_limit():
+					self._threads.remove(me)
+					return None
+					
+				startable_jobs = [a_job for a_job in self._jobs
+				                        if self._can_start(a_job)]
+				if startable_jobs and self._running < self._parallelism:
+					# Priorities change while jobs wait, so look them up now
+					job = min(startable_jobs, key=lambda j: j.priority)
+					self._jobs.remove(job)
+					if job.cancelled:
+						GLib.idle_add(self._deliver, job)
+						continue
+						
+					self._running += 1
+					self._running_groups[job.group] += 1
+					if self._sample_start is None:
+						self._sample_start = time.time()
+						
+					return job
+					
+				self._condition.wait()
+				
+	def _can_start(self, job):
+		return job.cancelled or job.group is None or not self.group_limit \
+		       or self._running_groups[job.group] < self.group_limit
+		       
+	def _work_loop(self):
+		job = self._next_job()
+		while job:
+			try:
+				job.result = job.work(job)
+				
+			except Exception as an_error:
+				job.error = an_error
+				
+			with self._condition:
+				self._running -= 1
+				self._running_groups[job.group] -= 1
+				self._measure(job)
+				self._condition.notify_all()
+				
+			GLib.idle_add(self._deliver, job)
+			job = self._next_job()
+			
+	def _measure(self, job):
+		''' Adapts the parallelism to the measured throughput '''
+		if not self._jobs:
+			# The pool is not saturated so the sample is meaningless
+			self._sample_start = None
+			self._sample_bytes = self._sample_count = 0
+			return
+			
+		self._sample_bytes += max(job.size, 1)
+		self._sample_count += 1
+		if self._sample_count >= DecodingEngine.SampleSize:
+			elapsed = max(time.time() - self._sample_start, 1e-6)
+			throughput = self._sample_bytes / elapsed
+			
+			if self._last_throughput is not None and \
+			   throughput < self._last_throughput:
+				# The last change made things worse, go back
+				self._direction *= -1
+				
+			limit = self.get_worker_limit()
+			new_parallelism = self._parallelism + self._direction
+			self._parallelism = max(1, min(limit, new_parallelism))
+			if self._parallelism in (1, limit):
+				self._direction = 1 if self._parallelism == 1 else -1
 				
+			self._last_throughput = throughput
+			self._sample_start = time.time()
+			self._sample_bytes = self._sample_count = 0
+			
+	def _deliver(self, job):
+		job.callback(job)
+		return False
+
+DecodingEngine.Default = DecodingEngine()
+# Copies distant files, a couple at a time for each host
+DecodingEngine.Transfers = DecodingEngine(workers=6)
+DecodingEngine.Transfers.group_limit = 2
+
 class ImageMeta():
 	''' Contains some assorted metadata of an image
 	    This should be used in sorting functions '''
@@ -388,155 +1104,478 @@ class ImageMeta():
 		return self.width * self.height
 	
 class ImageNode(Loadable):
+	__gsignals__ = {
+		# Emitted when a preview frame can be created or has changed
+		"preview-changed": (GObject.SIGNAL_RUN_FIRST, None, []),
+		# Emitted when metadata loaded in the background is ready
+		"metadata-changed": (GObject.SIGNAL_RUN_FIRST, None, [])
+	}
+	
 	def __init__(self):
 		Loadable.__init__(self)
 		
 		self.error = None
-		self.pixbuf = None
 		self.animation = None
 		self.metadata = None
+		# Loads the metadata in the background, see load_metadata_async
+		self._metadata_job = None
+		# A low resolution image node that can be shown while this loads
+		self.preview = None
 		
 		self.fullname, self.name = "", ""
 				
 	def __str__(self):
 		return self.fullname
+		
+	@property
+	def needs_metadata(self):
+		''' Whether the metadata is missing or only a placeholder
+		    until it's loaded in the background '''
+		return self.metadata is None or self._metadata_job is not None
+		
+	@property
+	def has_preview(self):
+		''' Whether a preview frame can be created for this image '''
+		return bool(self.preview and self.preview.on_memory and
+		            self.preview.image_size)
 	
 	def get_metadata(self):
 		if not self.metadata:
 			self.load_metadata()
 			
 		return self.metadata
+		
+	def get_memory_size(self):
+		''' Returns an estimate of the bytes used by the loaded image '''
+		result = 0
+		if self.animation:
+			# Only one frame of an animation is decoded at a time
+			width = self.animation.get_width()
+			height = self.animation.get_height()
+			result += width * height * 4
+			
+		return result
 	
 	def create_frame(self, view):
 		raise NotImplementedError
 
-import viewing
+import viewing, thumbnailing, caching, notification
 
-class GFileImageNode(ImageNode):
-	def __init__(self, gfile):
-		super().__init__()
-		self.gfile = gfile
-		
-		info = gfile.query_info("standard::display-name", 0, None)
-		self.name = info.get_attribute_as_string("standard::display-name")
-		self.fullname = self.gfile.get_parse_name()
-		
-		self.location = Location.Disk if gfile.is_native() else Location.Distant
-		
-class PixbufImageNode(ImageNode):
-	def __init__(self, pixbuf=None):
-		super().__init__()
-		self.pixbuf = pixbuf
-		self._surface = None
-	
-	@property
-	def surface(self):
-		if self._surface is None and self.pixbuf:
-			self._surface = viewing.SurfaceFromPixbuf(self.pixbuf)
+def ProbeImageSize(gfile, cancellable=None):
+	''' Reads just enough of a file to find out its image width and height.
+	    This blocks, so it should be called from a worker thread '''
+	if gfile.is_native():
+		fmt, width, height = GdkPixbuf.Pixbuf.get_file_info(gfile.get_path())
+		if fmt:
+			return width, height
 			
-		return self._surface
+	stream = gfile.read(cancellable)
+	try:
+		return ProbeStreamImageSize(stream, cancellable)
 		
-	def unload(self):
-		self._surface = None
+	finally:
+		stream.close(None)
 
-	def create_frame(self, view):
-		if self.surface is None:
-			raise DataError
+def ProbeStreamImageSize(stream, cancellable=None):
+	''' Like ProbeImageSize, but reads the image from a stream
+	    like the ones DecodeScaledPixbuf reads, which it doesn't close '''
+	sizes = []
+	loader = GdkPixbuf.PixbufLoader()
+	loader.connect("size-prepared", lambda l, w, h: sizes.append((w, h)))
+	try:
+		while not sizes:
+			some_bytes = stream.read_bytes(65536, cancellable)
+			if not some_bytes.get_size():
+				break
+				
+			loader.write(some_bytes.get_data())
+			
+	finally:
+		try:
+			loader.close()
+			
+		except GLib.GError:
+			pass # The image data was cut short on purpose
 			
-		return viewing.ImageSurfaceFrame(self.surface)
+	return sizes[0] if sizes else (0, 0)
 
-class PixbufDataImageNode(PixbufImageNode, ImageNode):
-	''' An ImageNode created from a pixbuf
-	    This ImageNode can not be loaded or unloaded
-	    Because it can not find the data source by itself '''
-	    
-	def __init__(self, pixbuf, name="Image Data"):
-		ImageNode.__init__(self)
-		PixbufImageNode.__init__(self, pixbuf)
-		
-		self.fullname = self.name = name
+# Number of images whose metadata is probed in the same job
+ProbeChunkSize = 64
+
+def ProbeMetadata(images, progress_callback=None, cancellable=None):
+	''' Loads the metadata of many images at once, probing the headers of
+	    files in chunks spread over the worker threads of the default engine.
+	    The chunks are queued behind loading images, like the metadata
+	    loaded in the background. Returns a tasking.Task, progress_callback
+	    is called with the number of images probed so far and the total '''
+	cancellable = cancellable or Gio.Cancellable()
+	return tasking.Task(_ProbeMetadata(images, progress_callback,
+	                                   cancellable), cancellable)
+
+def _ProbeMetadata(images, progress_callback, cancellable):
+	total = len(images)
+	probed = 0
+	files = []
+	for an_image in images:
+		if hasattr(an_image, "_probe_metadata"):
+			files.append(an_image)
+			
+		else:
+			# Other nodes have their metadata at hand
+			an_image.load_metadata()
+			probed += 1
+			
+	chunks = [files[i:i + ProbeChunkSize]
+	          for i in range(0, len(files), ProbeChunkSize)]
+	# Every chunk is queued right away and they finish in about this order.
+	# The jobs share the cancellable so cancelling the task stops them all
+	futures = [DecodingEngine.Default.run(_ProbeChunk(a_chunk), cancellable,
+	                                      priority=GLib.MAXINT)
+	           for a_chunk in chunks]
+	if progress_callback:
+		progress_callback(probed, total)
 		
-		self.load_metadata()
+	for a_chunk, a_future in zip(chunks, futures):
+		try:
+			results = yield from a_future
+			
+		except tasking.Cancelled:
+			raise
+			
+		except Exception:
+			results = [(None, None)] * len(a_chunk)
+			
+		for an_image, a_result in zip(a_chunk, results):
+			if an_image._metadata_job is not None:
+				# Probed already, no need to wait for it
+				an_image._metadata_job.cancel()
+				an_image._metadata_job = None
+				
+			an_image._apply_probed_metadata(a_result)
+			an_image.emit("metadata-changed")
+			
+		probed += len(a_chunk)
+		if progress_callback:
+			progress_callback(probed, total)
+
+def _ProbeChunk(images):
+	''' Returns work for a decoding job that probes some images '''
+	def probe(job):
+		return [an_image._probe_metadata(job) for an_image in images]
 		
-		self.location = Location.Memory
-		self.status = Status.Good
+	return probe
+
+def DecodeScaledPixbuf(stream, fit=None, limit=0, cancellable=None,
+                       area_updated=None):
+	''' Decodes a pixbuf from a stream, scaling it down while decoding.
+	    "fit" is a (view size, zoom mode) pair for the view the image
+	    will be shown in and "limit" is the maximum number of bytes
+	    the decoded image may use, zero meaning no limit.
+	    "area_updated" is called from the calling thread with the
+	    partially decoded pixbuf, the actual size of the image and the
+	    (x, y, width, height) area of the pixbuf that was just decoded.
+	    Returns the pixbuf and the actual size of the image.
+	    This blocks, so it should be called from a worker thread '''
+	sizes = []
+	def size_prepared(loader, width, height):
+		sizes.append((width, height))
+		scale = 1
+		if fit:
+			view_size, zoom_mode = fit
+			# Rotated images swap sides, so fit either of them
+			scale = max(viewing.ZoomForSize(view_size, (width, height),
+			                                zoom_mode),
+			            viewing.ZoomForSize(view_size, (height, width),
+			                                zoom_mode))
+			
+		if limit:
+			# Only the cairo surface is kept, with 4 bytes per pixel
+			scale = min(scale, (limit / (width * height * 4)) ** .5)
+			
+		if scale < 1:
+			loader.set_size(max(1, round(width * scale)),
+			                max(1, round(height * scale)))
+			
+	loader = GdkPixbuf.PixbufLoader()
+	loader.connect("size-prepared", size_prepared)
+	if area_updated:
+		loader.connect("area-updated",
+		               lambda loader, *area: area_updated(loader.get_pixbuf(),
+		                                                  sizes[0], area))
 		
-	def load_metadata(self):
-		if self.metadata is None:
-			self.metadata = ImageMeta()
+	try:
+		while True:
+			some_bytes = stream.read_bytes(65536, cancellable)
+			if not some_bytes.get_size():
+				break
+				
+			loader.write(some_bytes.get_data())
 			
-		self.metadata.width = self.pixbuf.get_width()
-		self.metadata.height = self.pixbuf.get_height()
-		self.metadata.modification_date = time.time()
-		self.metadata.data_size = 0
+	except Exception:
+		try:
+			loader.close()
+			
+		except GLib.GError:
+			pass
+			
+		raise
 		
-	def unload(self):
-		PixbufImageNode.unload(self)
-		self.pixbuf = None
-		self.location &= ~Location.Memory
-		self.status = Status.Bad
+	loader.close()
+	pixbuf = loader.get_pixbuf()
+	if pixbuf is None:
+		raise DataError
+		
+	return pixbuf, sizes[0]
 
-class PixbufFileImageNode(GFileImageNode, PixbufImageNode):
+class GFileImageNode(ImageNode):
+	MetadataInfo = "standard::size,time::modified"
+	
 	def __init__(self, gfile):
-		super().__init__(gfile=gfile)
-		
-		self.status = Status.Good
+		super().__init__()
+		self.gfile = gfile
+		# A copy of a distant file in the file cache
+		self.local_file = None
 		self.cancellable = None
+		self._job = None
 		
-	def load(self):
-		if self.is_loading:
-			raise Exception
-			
-		self.cancellable = Gio.Cancellable()
-		
-		stream = self.gfile.read(None)
+		self.fullname = self.gfile.get_parse_name()
 		
-		self.status = Status.Loading
-		load_async = GdkPixbuf.Pixbuf.new_from_stream_async
-		self.pixbuf = load_async(stream, self.cancellable, self._loaded, None)
+		# Use the display name enumerated along with the file if possible
+		# so that creating a node doesn't block on querying the file info
+		info = getattr(gfile, "info", None)
+		if info and info.has_attribute("standard::display-name"):
+			self.name = info.get_display_name()
+			
+		elif gfile.is_native():
+			# This is what GIO would return for native files anyway
+			self.name = GLib.filename_display_name(gfile.get_basename())
+			
+		else:
+			self.name = gfile.get_basename() or self.fullname
+			gfile.query_info_async("standard::display-name", 0,
+			                       GLib.PRIORITY_LOW, None,
+			                       self._display_name_queried, None)
+			
+		self.location = Location.Disk if gfile.is_native() else Location.Distant
 		
-	def _loaded(self, me, result, *data):
-		self.error = None
+	def _display_name_queried(self, gfile, result, *data):
 		try:
-			async_finish = GdkPixbuf.Pixbuf.new_from_stream_finish
-			self.pixbuf = async_finish(result)
-
-		except GLib.GError as gerror:
-			# If cancellable is None, that means loading was cancelled
-			if self.cancellable:
-				self.location &= ~Location.Memory
-				self.status = Status.Bad
-				self.error = gerror
+			info = gfile.query_info_finish(result)
+			self.name = info.get_display_name()
+			
+		except Exception:
+			pass
+			
+	def _priority_changed(self):
+		# Reorders the job in the engine queue if it didn't start yet
+		if self._job:
+			self._job.priority = self.priority
+			
+	def load(self):
+		''' Loads the image. Distant files are copied to the file cache
+		    first and then decoded from the copy '''
+		if self.is_loading:
+			raise Exception
+			
+		# Copies can be deleted from the cache to make room for others
+		if self.local_file and not self.local_file.query_exists(None):
+			self.local_file = None
+			self.location = self.location & ~Location.Disk | Location.Distant
+			
+		self.cancellable = Gio.Cancellable()
+		if self.location & Location.Distant and caching.FileCache.Default.limit:
+			self.status = Status.Caching
+			host = urllib.parse.urlsplit(self.gfile.get_uri()).netloc
+			self._job = DecodingEngine.Transfers.submit(
+			                self._stage, self._staged, self.cancellable,
+			                self.priority, host)
 			
 		else:
-			self.location |= Location.Memory
-			self.status = Status.Good
-			self.load_metadata()
+			self.status = Status.Loading
+			self._start_decoding()
 			
-		finally:
+	def _start_decoding(self):
+		''' Submits the decoding of the file, implemented by subclasses '''
+		raise NotImplementedError
+		
+	def _stage(self, job):
+		''' Copies the file to the file cache, runs in a worker thread.
+		    Returns the path of the copy '''
+		file_cache = caching.FileCache.Default
+		uri = self.gfile.get_uri()
+		file_info = self.gfile.query_info(GFileImageNode.MetadataInfo, 0,
+		                                  job.cancellable)
+		mtime = file_info.get_attribute_uint64("time::modified")
+		job.size = file_info.get_size()
+		
+		path = file_cache.lookup(uri, mtime)
+		if path is None:
+			temp_path = file_cache.create_temp_path()
+			try:
+				self.gfile.copy(Gio.File.new_for_path(temp_path),
+				                Gio.FileCopyFlags.OVERWRITE,
+				                job.cancellable, None, None)
+				path = file_cache.add(uri, mtime, temp_path)
+				
+			except Exception:
+				os.remove(temp_path)
+				raise
+				
+		return path
+		
+	def _staged(self, job):
+		# Results from jobs cancelled by unload are of no interest
+		if job is not self._job:
+			return
+			
+		if job.error:
 			self.cancellable = None
+			self._job = None
+			if self.on_memory:
+				# Failed to load it again, keep showing what was loaded
+				self.status = Status.Good
+				self.error = None
+				
+			else:
+				self.status = Status.Bad
+				self.error = job.error
+				
 			self.emit("finished-loading", self.error)
 			
-	def unload(self):
-		if self.cancellable:
-			self.cancellable.cancel()
-			self.cancellable = None
-		
-		PixbufImageNode.unload(self)
-		self.pixbuf = None
-		self.location &= ~Location.Memory
-		self.status = Status.Good
+		else:
+			self.local_file = Gio.File.new_for_path(job.result)
+			self.location = self.location & ~Location.Distant | Location.Disk
+			self.status = Status.Loading
+			self._start_decoding()
+			
+	def _read(self, cancellable):
+		''' Opens the file for reading, from the local copy if possible.
+		    Returns the stream and the file info of the file it reads '''
+		if self.local_file:
+			try:
+				a_file = self.local_file
+				stream = a_file.read(cancellable)
+				
+			except GLib.Error:
+				# Deleted from the cache in the meanwhile
+				a_file = self.gfile
+				stream = a_file.read(cancellable)
+				
+		else:
+			a_file = self.gfile
+			stream = a_file.read(cancellable)
+			
+		try:
+			file_info = a_file.query_info(GFileImageNode.MetadataInfo, 0,
+			                              cancellable)
+			
+		except Exception:
+			file_info = None
+			
+		return stream, file_info
 		
 	def load_metadata(self):
-		if self.metadata is None:
-			self.metadata = ImageMeta()
+		''' Sets placeholder metadata, with the image size if it's loaded,
+		    and loads the actual metadata in the background, emitting
+		    "metadata-changed" once it's there. Querying the file and
+		    the metadata cache would block '''
+		self._set_metadata(None, self._get_loaded_size())
+		self.load_metadata_async()
 		
-		# These file properties are queried from the file info
+	def load_metadata_async(self):
+		''' Loads the metadata in a worker thread,
+		    emits "metadata-changed" once it's done '''
+		if self._metadata_job is None:
+			self._metadata_job = DecodingEngine.Default.submit(
+			                         self._probe_metadata,
+			                         self._metadata_probed,
+			                         priority=GLib.MAXINT)
+			
+	def _probe_metadata(self, job):
+		''' Queries file info and image size, runs in a worker thread '''
 		try:
 			file_info = self.gfile.query_info(
-			                       "standard::size,time::modified", 0, None)
-
+			                       GFileImageNode.MetadataInfo, 0,
+			                       job.cancellable)
+			
 		except Exception:
+			file_info = None
+			
+		size = self._get_cached_size(file_info)
+		if size is None:
+			try:
+				size = ProbeImageSize(self.gfile, job.cancellable)
+				
+			except Exception:
+				pass
+				
+			else:
+				self._cache_size(file_info, size)
+				
+		return file_info, size
+		
+	def _metadata_probed(self, job):
+		# Jobs replaced by ProbeMetadata are of no interest
+		if job is not self._metadata_job:
+			return
+			
+		self._metadata_job = None
+		self._apply_probed_metadata(job.result or (None, None))
+		self.emit("metadata-changed")
+		
+	def _apply_probed_metadata(self, result):
+		''' Sets the metadata from what _probe_metadata returned '''
+		file_info, size = result
+		self._set_metadata(file_info, self._get_loaded_size() or size)
+		
+	def _get_cache_key(self, file_info):
+		''' Returns the uri, size and mtime of the file or None '''
+		if file_info is None or \
+		   not file_info.has_attribute("time::modified"):
+			return None
+			
+		mtime = file_info.get_attribute_uint64("time::modified")
+		return self.gfile.get_uri(), file_info.get_size(), mtime
+		
+	def _get_cached_size(self, file_info):
+		''' Returns the image size stored in the metadata cache or None '''
+		key = self._get_cache_key(file_info)
+		return caching.MetadataCache.Default.lookup(*key) if key else None
+		
+	def _cache_size(self, file_info, size):
+		''' Stores the image size in the metadata cache '''
+		key = self._get_cache_key(file_info)
+		if key and size and size[0] and size[1]:
+			caching.MetadataCache.Default.store(*(key + tuple(size)))
+			
+	def _update_cached_size(self, file_info, size):
+		''' Stores the size of a decoded image in the metadata cache
+		    unless it's there already. Called from worker threads '''
+		if self._get_cached_size(file_info) != size:
+			self._cache_size(file_info, size)
+		
+	def _get_loaded_size(self):
+		''' Returns the size of the image in memory or None '''
+		if getattr(self, "image_size", None):
+			# The image was decoded at a smaller size
+			return self.image_size
+			
+		elif getattr(self, "surface", None):
+			return self.surface.get_width(), self.surface.get_height()
+			
+		elif self.animation:
+			return self.animation.get_width(), self.animation.get_height()
+			
+		else:
+			return None
+			
+	def _set_metadata(self, file_info, size):
+		''' Fills the metadata from a file info and an image size '''
+		if self.metadata is None:
+			self.metadata = ImageMeta()
+			
+		# These file properties are queried from the file info
+		if file_info is None:
 			self.metadata.modification_date = float(time.time())
 			self.metadata.data_size = 0
 			
@@ -554,80 +1593,657 @@ class PixbufFileImageNode(GFileImageNode, PixbufImageNode):
 				
 			except Exception:
 				self.metadata.modification_date = float(time.time())
+				
+		# Sizes that are not known are only probed by load_metadata_async
+		self.metadata.width, self.metadata.height = size or (0, 0)
+
+class SharedSurface:
+	''' A decoded surface that nodes of identical files share.
+	    "users" counts the nodes holding it, it is only changed
+	    while holding Lock since nodes are looked up from worker threads '''
+	Lock = threading.Lock()
+	
+	def __init__(self, surface, image_size):
+		self.surface = surface
+		self.image_size = image_size
+		self.users = 0
+
+class PixbufImageNode(ImageNode):
+	''' An image node that keeps its pixels in a cairo surface.
+	    Pixbufs are only kept while they are converted '''
+	def __init__(self, pixbuf=None):
+		super().__init__()
+		self._surface = viewing.SurfaceFromPixbuf(pixbuf) if pixbuf else None
+		# The size of the image if the surface is smaller than it
+		self.image_size = None
+		# Created along with the first frame
+		self._frames = None
+		# The SharedSurface of the surface set by _refresh_frames
+		self._shared = None
+		# A surface that is drawn on while the image is decoded
+		# and the size of the image it's for
+		self._partial_surface = None
+		self._partial_size = None
+		
+	@property
+	def has_preview(self):
+		return self._partial_surface is not None or \
+		       ImageNode.has_preview.fget(self)
+	
+	@property
+	def decoded_scale(self):
+		''' The size of the surface relative to the image size '''
+		if self._surface and self.image_size:
+			return self._surface.get_width() / self.image_size[0]
+			
+		else:
+			return 1
+	
+	@property
+	def surface(self):
+		return self._surface
 		
-		# The width and height of the image are loaded from guess where
-		if self.pixbuf:
-			self.metadata.width = self.pixbuf.get_width()
-			self.metadata.height = self.pixbuf.get_height()
+	@property
+	def pixbuf(self):
+		''' A new pixbuf copied from the surface or None.
+		    It is not kept, so hold it only for as long as it's needed '''
+		if self._surface is None:
+			return None
 			
-		elif self.gfile.is_native():
-			try:
-				filepath = self.gfile.get_path()
-				fmt, width, height = GdkPixbuf.Pixbuf.get_file_info(filepath)
-				self.metadata.width = width
-				self.metadata.height = height
+		return Gdk.pixbuf_get_from_surface(self._surface, 0, 0,
+		                                   self._surface.get_width(),
+		                                   self._surface.get_height())
+		
+	def get_memory_size(self):
+		result = ImageNode.get_memory_size(self)
+		for a_surface in (self._surface, self._partial_surface):
+			if a_surface:
+				a_size = a_surface.get_stride() * a_surface.get_height()
+				if a_surface is self._surface and self._shared:
+					# Surfaces shared by several nodes are split among them
+					a_size //= max(1, self._shared.users)
+					
+				result += a_size
 				
-			except Exception:
-				self.metadata.width = 0
-				self.metadata.height = 0
+		return result
+		
+	def unload(self):
+		self._release_surface()
+		self._surface = None
+		self._partial_surface = None
+		self._partial_size = None
+		self.image_size = None
+
+	def create_frame(self, view):
+		if self.surface is not None:
+			surface, image_size = self.surface, self.image_size
+			
+		elif self._partial_surface is not None:
+			surface, image_size = self._partial_surface, self._partial_size
+			
+		elif self.has_preview:
+			# The frame surface is replaced once this is loaded
+			surface, image_size = self.preview.surface, self.preview.image_size
+			
+		else:
+			raise DataError
+			
+		new_frame = viewing.ImageSurfaceFrame(surface, image_size)
+		if self._frames is None:
+			self._frames = weakref.WeakSet()
+			
+		self._frames.add(new_frame)
+		return new_frame
+		
+	def _refresh_frames(self, surface, shared=None):
+		''' Sets the surface of the image and of the frames
+		    that were created for an older surface or a preview.
+		    "shared" is the SharedSurface of another node the surface
+		    comes from, otherwise other nodes can share it from now on '''
+		self._release_surface()
+		self._surface = surface
+		if shared is None:
+			shared = SharedSurface(surface, self.image_size or
+			                       (surface.get_width(), surface.get_height()))
+			
+		with SharedSurface.Lock:
+			shared.users += 1
+			self._shared = shared
+			
+		self._partial_surface = None
+		self._partial_size = None
+		for a_frame in self._frames or ():
+			a_frame.surface = self.surface
+			
+	def _release_surface(self):
+		with SharedSurface.Lock:
+			if self._shared is not None:
+				self._shared.users -= 1
+				self._shared = None
+				
+	
+	@staticmethod
+	def _CopyPartial(pixbuf, area):
+		''' Copies an (x, y, width, height) area of a pixbuf that is being
+		    decoded to a surface at the size of the partial surface.
+		    This runs in the worker thread decoding the pixbuf, in between
+		    writes to it. Returns the surface, its position in the partial
+		    surface and the size of the partial surface '''
+		width, height = pixbuf.get_width(), pixbuf.get_height()
+		scale = min(1, PixbufImageNode.PartialSide / max(width, height))
+		x, y, area_width, area_height = area
+		left, top = math.floor(x * scale), math.floor(y * scale)
+		right = math.ceil((x + area_width) * scale)
+		bottom = math.ceil((y + area_height) * scale)
+		piece = pixbuf.new_subpixbuf(*area)
+		if scale < 1:
+			piece = piece.scale_simple(max(1, right - left),
+			                           max(1, bottom - top),
+			                           GdkPixbuf.InterpType.BILINEAR)
 			
-		# TODO: Add support for non-native files
+		partial_size = (max(1, round(width * scale)),
+		                max(1, round(height * scale)))
+		return viewing.SurfaceFromPixbuf(piece), (left, top), partial_size
+		
+	def _draw_partial(self, piece, position, partial_size, image_size):
+		''' Paints a piece copied by _CopyPartial on the partial surface,
+		    which is shown in place of the preview '''
+		if self._partial_surface is None:
+			width, height = partial_size
+			surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+			# Rows that are not decoded yet keep showing the preview
+			if self.has_preview:
+				preview_surface = self.preview.surface
+				cr = cairo.Context(surface)
+				cr.scale(width / preview_surface.get_width(),
+				         height / preview_surface.get_height())
+				cr.set_source_surface(preview_surface, 0, 0)
+				cr.paint()
+				
+			self._partial_surface = surface
+			self._partial_size = image_size
+			self._paint_piece(piece, position)
+			for a_frame in self._frames or ():
+				a_frame.image_size = image_size
+				a_frame.surface = surface
+				
+			self.emit("preview-changed")
+			
+		else:
+			self._paint_piece(piece, position)
+			for a_frame in self._frames or ():
+				a_frame.redraw()
+				
+	def _paint_piece(self, piece, position):
+		cr = cairo.Context(self._partial_surface)
+		cr.set_operator(cairo.OPERATOR_SOURCE)
+		cr.set_source_surface(piece, *position)
+		cr.paint()
 
-class PixbufAnimationFileImageNode(GFileImageNode, PixbufImageNode):
-	def __init__(self, gfile):
-		super().__init__(gfile=gfile)
+# Maximum side length of the surface shown while an image is decoded
+PixbufImageNode.PartialSide = 2048
+
+class PixbufDataImageNode(PixbufImageNode, ImageNode):
+	''' An ImageNode created from a pixbuf
+	    This ImageNode can not be loaded or unloaded
+	    Because it can not find the data source by itself '''
+	    
+	def __init__(self, pixbuf, name="Image Data"):
+		ImageNode.__init__(self)
+		PixbufImageNode.__init__(self, pixbuf)
 		
-		self.animation = None
+		self.fullname = self.name = name
+		
+		self.load_metadata()
 		
+		self.location = Location.Memory
+		self.status = Status.Good
+		
+	def load_metadata(self):
+		if self.metadata is None:
+			self.metadata = ImageMeta()
+			
+		self.metadata.width = self._surface.get_width()
+		self.metadata.height = self._surface.get_height()
+		self.metadata.modification_date = time.time()
+		self.metadata.data_size = 0
+		
+	def unload(self):
+		PixbufImageNode.unload(self)
+		self.location &= ~Location.Memory
+		self.status = Status.Bad
+
+class ThumbnailImageNode(PixbufImageNode):
+	''' The thumbnail of a GFileImageNode in the thumbnail cache.
+	    It is bad while there is no thumbnail cached, until one is created
+	    from the loaded source image. The source image may finish loading
+	    before the cache is read, so a thumbnail created from it is kept
+	    until it's known whether the cache had one already '''
+	
+	def __init__(self, source, size=thumbnailing.Size.Large):
+		super().__init__()
+		self.source = source
+		self.size = size
+		self.fullname = self.name = source.fullname
+		
+		self.location = source.location
 		self.status = Status.Good
 		self.cancellable = None
+		self._job = None
+		# Whether the cache had no thumbnail, None until it's read
+		self.missing = None
+		# A (thumbnail, image size, mtime) waiting to be saved
+		self._thumbnail = None
 		
 	def load(self):
 		if self.is_loading:
 			raise Exception
 			
 		self.cancellable = Gio.Cancellable()
-		
-		stream = self.gfile.read(None)
-		parsename = self.gfile.get_parse_name()
-		
 		self.status = Status.Loading
-		load_async = GdkPixbuf.PixbufAnimation.new_from_stream_async
-		self.animation = load_async(stream, self.cancellable,
-		                            self._loaded, None)
+		self._job = DecodingEngine.Default.submit(
+		                self._read, self._loaded, self.cancellable,
+		                self.priority)
+		
+	def _read(self, job):
+		''' Reads the cached thumbnail, runs in a worker thread '''
+		gfile = self.source.gfile
+		file_info = gfile.query_info("time::modified", 0, job.cancellable)
+		mtime = file_info.get_attribute_uint64("time::modified")
+		return thumbnailing.Load(gfile.get_uri(), mtime, self.size)
 		
-	def _loaded(self, me, result, *data):
+	def _loaded(self, job):
+		if job is not self._job:
+			return
+			
 		self.error = None
+		pixbuf, image_size = job.result or (None, None)
+		if pixbuf:
+			if image_size is None and self.source.metadata:
+				# Thumbnails from other programs may lack the image size
+				width = self.source.metadata.width
+				height = self.source.metadata.height
+				image_size = (width, height) if width and height else None
+				
+			self._set_pixbuf(pixbuf, image_size)
+			self.missing = False
+			self._thumbnail = None
+			
+		else:
+			self.status = Status.Bad
+			self.error = job.error
+			self.missing = job.error is None
+			
+		self.cancellable = None
+		self._job = None
+		self.emit("finished-loading", self.error)
+		
+		if self.missing and self._thumbnail:
+			self._save_thumbnail()
+			
+	def create_from(self, pixbuf, image_size, mtime):
+		''' Creates the thumbnail from a loaded image of the source
+		    in a worker thread and stores it in the cache once the
+		    cache is known to have none '''
+		def create_thumbnail(job):
+			return thumbnailing.Create(pixbuf, image_size, self.size)
+			
+		job = DecodingEngine.Default.submit(create_thumbnail, self._created,
+		                                    priority=GLib.MAXINT)
+		job.image_size = image_size
+		job.mtime = mtime
+		
+	def _created(self, job):
+		if job.error:
+			notification.log(notification.Lines.Error(job.error))
+			
+		elif job.result and self.missing is not False:
+			self._thumbnail = job.result, job.image_size, job.mtime
+			if self.missing:
+				self._save_thumbnail()
+				
+	def _save_thumbnail(self):
+		thumbnail, image_size, mtime = self._thumbnail
+		self._thumbnail = None
+		self.missing = False
+		
+		uri = self.source.gfile.get_uri()
+		def save_thumbnail(job):
+			thumbnailing.Save(thumbnail, uri, mtime, image_size, self.size)
+			
+		job = DecodingEngine.Default.submit(save_thumbnail, self._saved,
+		                                    priority=GLib.MAXINT)
+		job.thumbnail = thumbnail
+		job.image_size = image_size
+		
+	def _saved(self, job):
+		if job.error:
+			notification.log(notification.Lines.Error(job.error))
+			
+		if not (self.on_memory or self.is_loading):
+			self._set_pixbuf(job.thumbnail, job.image_size)
+			self.emit("finished-loading", None)
+			
+	def _set_pixbuf(self, pixbuf, image_size):
+		self.image_size = image_size
+		self._surface = viewing.SurfaceFromPixbuf(pixbuf)
+		self.location |= Location.Memory
+		self.status = Status.Good
+		
+	def unload(self):
+		if self.cancellable:
+			self.cancellable.cancel()
+			self.cancellable = None
+			self._job = None
+			
+		# The file may have changed by the time the cache is read again
+		self.missing = None
+		self._thumbnail = None
+		PixbufImageNode.unload(self)
+		self.location &= ~Location.Memory
+		self.status = Status.Good
+
+class PixbufFileImageNode(GFileImageNode, PixbufImageNode):
+	''' Maximum number of bytes a decoded image may use,
+	    bigger images are decoded at a smaller size. Zero means no limit '''
+	DecodeLimit = 0
+	''' Whether to show cached thumbnails while images load '''
+	UseThumbnails = True
+	''' Whether to show images while they are decoded '''
+	Progressive = True
+	''' Minimum number of seconds between redraws of images being decoded '''
+	ProgressiveInterval = 0.1
+	
+	def __init__(self, gfile):
+		super().__init__(gfile=gfile)
+		
+		self.status = Status.Good
+		# A (view size, zoom mode) pair to decode the image for, or None
+		# to decode it at its actual size
+		self.fit = None
+		# The fit the surface was decoded for
+		self._decoded_fit = None
+		
+	def _preview_loaded(self, preview, error):
+		if not error:
+			self.emit("preview-changed")
+			
+	def _uses_changed(self):
+		# The preview is used for as long as this is used. It's only
+		# created when this is first used, most images opened never are
+		if self.preview is None and self.uses and \
+		   PixbufFileImageNode.UseThumbnails:
+			self.preview = ThumbnailImageNode(self)
+			self.preview.connect("finished-loading", self._preview_loaded)
+			if self.memory is not None:
+				self.memory.observe(self.preview)
+				
+		if self.preview is not None:
+			self.preview.uses = self.uses
+			
+		GFileImageNode._uses_changed(self)
+		
+	def _start_decoding(self):
+		# If the image is already loaded at a smaller size,
+		# it is loaded again at the size it should have now
+		fit = self.fit
+		# Images already shown are not shown again while they are decoded
+		progressive = PixbufFileImageNode.Progressive and not self.on_memory
+		self._job = DecodingEngine.Default.submit(
+		                lambda job: self._decode(job, fit, progressive),
+		                self._loaded, self.cancellable, self.priority)
+		self._job.fit = fit
+		
+	def _decode(self, job, fit=None, progressive=False):
+		''' Reads and decodes the file, runs in a worker thread.
+		    Returns the pixbuf, which is None if the surface was shared
+		    with a node of an identical file, the surface, the image size,
+		    the file info and the content of the file or None '''
+		content = self._identify()
+		if content:
+			shared = caching.ContentIndex.Default.find(
+			             content, lambda other: other._get_shared(fit))
+			if shared:
+				try:
+					file_info = (self.local_file or self.gfile).query_info(
+					                GFileImageNode.MetadataInfo, 0,
+					                job.cancellable)
+					                
+				except Exception:
+					file_info = None
+					
+				self._update_cached_size(file_info, shared.image_size)
+				return (None, shared.surface, shared.image_size, file_info,
+				        content, shared)
+				
+		stream, file_info = self._read(job.cancellable)
+		if file_info:
+			job.size = file_info.get_size()
+			
+		area_updated = None
+		if progressive:
+			# Areas are gathered until it's time to redraw
+			job.updated_area = None
+			job.update_time = time.monotonic()
+			area_updated = lambda *args: self._area_updated(job, *args)
+			
+		try:
+			limit = PixbufFileImageNode.DecodeLimit
+			pixbuf, image_size = DecodeScaledPixbuf(stream, fit, limit,
+			                                        job.cancellable,
+			                                        area_updated)
+			
+		finally:
+			stream.close(None)
+			
+		# Converting big images takes a while, better not on the main thread
+		surface = viewing.SurfaceFromPixbuf(pixbuf)
+		self._update_cached_size(file_info, image_size)
+		return pixbuf, surface, image_size, file_info, content, None
+		
+	def _identify(self):
+		# Runs in the worker thread, files without a local path
+		# are not worth reading twice
+		if not caching.ContentIndex.Default.enabled:
+			return None
+			
+		local_file = self.local_file or self.gfile
+		path = local_file.get_path()
+		if path is None:
+			return None
+			
 		try:
-			async_finish = GdkPixbuf.PixbufAnimation.new_from_stream_finish
-			self.animation = async_finish(result)
+			return caching.ContentIndex.Default.identify(path)
+			
+		except OSError:
+			return None
+			
+	def _get_shared(self, fit):
+		''' Returns the SharedSurface of this if it was decoded for fit,
+		    or None. Called from worker threads '''
+		with SharedSurface.Lock:
+			if self._shared is None or self._decoded_fit != fit:
+				return None
+				
+			return self._shared
+		
+	def _area_updated(self, job, pixbuf, image_size, area):
+		# Runs in the worker thread, for every few decoded rows
+		if job.updated_area:
+			old_x, old_y, old_width, old_height = job.updated_area
+			x, y, width, height = area
+			left, top = min(old_x, x), min(old_y, y)
+			right = max(old_x + old_width, x + width)
+			bottom = max(old_y + old_height, y + height)
+			area = left, top, right - left, bottom - top
+			
+		job.updated_area = area
+		now = time.monotonic()
+		if now - job.update_time >= PixbufFileImageNode.ProgressiveInterval:
+			job.update_time = now
+			job.updated_area = None
+			# The loader is only written to in this thread, so
+			# the pixbuf is copied from here and not from the main loop
+			piece, position, partial_size = \
+			       PixbufImageNode._CopyPartial(pixbuf, area)
+			GLib.idle_add(self._show_partial, job, piece, position,
+			              partial_size, image_size)
 			
-			if self.animation.is_static_image():
-				self.pixbuf = self.animation.get_static_image()
-				self.animation = None
+	def _show_partial(self, job, piece, position, partial_size, image_size):
+		if job is self._job:
+			self._draw_partial(piece, position, partial_size, image_size)
+			
+		return False
+		
+	def _loaded(self, job):
+		# Results from jobs cancelled by unload are of no interest
+		if job is not self._job:
+			return
+			
+		self.error = None
+		try:
+			if job.error:
+				raise job.error
+				
+			pixbuf, surface, image_size, file_info, content, shared = \
+			                                                    job.result
 
-		except GLib.GError as gerror:
-			# If cancellable is None, that means loading was cancelled
-			if self.cancellable:
+		except Exception as a_problem:
+			if self._surface:
+				# Failed to load it bigger, keep showing the smaller one
+				self.status = Status.Good
+				
+			else:
 				self.location &= ~Location.Memory
 				self.status = Status.Bad
-				self.error = gerror
+				self.error = a_problem
+				self._partial_surface = None
+				self._partial_size = None
 			
 		else:
+			# Only the surface is kept, the pixbuf is let go once
+			# a thumbnail is created from it
+			if surface.get_width() < image_size[0]:
+				self.image_size = image_size
+				
+			else:
+				self.image_size = None
+				
+			# Set first, nodes decoding identical files look it up
+			self._decoded_fit = job.fit
+			self._refresh_frames(surface, shared)
 			self.location |= Location.Memory
 			self.status = Status.Good
-			self.load_metadata()
+			self._set_metadata(file_info, image_size)
+			
+			if content:
+				caching.ContentIndex.Default.add(content, self)
+			
+			# Previews not found in the cache, or not looked up yet,
+			# get a thumbnail created
+			if self.preview and self.preview.missing is not False \
+			   and file_info and pixbuf is not None:
+				mtime = file_info.get_attribute_uint64("time::modified")
+				self.preview.create_from(pixbuf, image_size, mtime)
 			
 		finally:
 			self.cancellable = None
+			self._job = None
+			self.emit("finished-loading", self.error)
+			
+	def unload(self):
+		if self.cancellable:
+			self.cancellable.cancel()
+			self.cancellable = None
+			self._job = None
+		
+		# Nothing can be shared from this until it's loaded again
+		caching.ContentIndex.Default.remove(self)
+		PixbufImageNode.unload(self)
+		self.location &= ~Location.Memory
+		self.status = Status.Good
+
+class PixbufAnimationFileImageNode(GFileImageNode, PixbufImageNode):
+	def __init__(self, gfile):
+		super().__init__(gfile=gfile)
+		
+		self.animation = None
+		# Plays the animation for all the frames created for it
+		self._player = None
+		
+		self.status = Status.Good
+		
+	def get_memory_size(self):
+		result = PixbufImageNode.get_memory_size(self)
+		if self._player:
+			result += self._player.get_memory_size()
+			
+		return result
+		
+	def _start_decoding(self):
+		self._job = DecodingEngine.Default.submit(
+		                self._decode, self._loaded, self.cancellable,
+		                self.priority)
+		
+	def _decode(self, job):
+		''' Reads and decodes the file, runs in a worker thread '''
+		stream, file_info = self._read(job.cancellable)
+		if file_info:
+			job.size = file_info.get_size()
+			
+		try:
+			new_animation = GdkPixbuf.PixbufAnimation.new_from_stream
+			animation = new_animation(stream, job.cancellable)
+			
+		finally:
+			stream.close(None)
+			
+		size = animation.get_width(), animation.get_height()
+		self._update_cached_size(file_info, size)
+		if animation.is_static_image():
+			# Static images are kept as surfaces, like any other image
+			surface = viewing.SurfaceFromPixbuf(animation.get_static_image())
+			return None, surface, file_info
+			
+		else:
+			return animation, None, file_info
+			
+	def _loaded(self, job):
+		# Results from jobs cancelled by unload are of no interest
+		if job is not self._job:
+			return
+			
+		self.error = None
+		try:
+			if job.error:
+				raise job.error
+				
+			self.animation, self._surface, file_info = job.result
+
+		except Exception as a_problem:
+			self.location &= ~Location.Memory
+			self.status = Status.Bad
+			self.error = a_problem
+			
+		else:
+			self.location |= Location.Memory
+			self.status = Status.Good
+			self._set_metadata(file_info, self._get_loaded_size())
+			
+		finally:
+			self.cancellable = None
+			self._job = None
 			self.emit("finished-loading", self.error)
 	
 	def create_frame(self, view):
-		if self.pixbuf:
+		if self._surface:
 			return PixbufImageNode.create_frame(self, view)
 			
 		elif self.animation:
-			return viewing.AnimatedPixbufFrame(self.animation)
+			if self._player is None:
+				self._player = viewing.AnimationPlayer(self.animation)
+				
+			return viewing.AnimatedPixbufFrame(self.animation, self._player)
 			
 		else:
 			raise DataError
@@ -636,53 +2252,293 @@ class PixbufAnimationFileImageNode(GFileImageNode, PixbufImageNode):
 		if self.cancellable:
 			self.cancellable.cancel()
 			self.cancellable = None
+			self._job = None
 		
 		PixbufImageNode.unload(self)
-		self.pixbuf = None
 		self.animation = None
+		self._player = None
 		self.location &= ~Location.Memory
 		self.status = Status.Good
+
+class FileObjectStream:
+	''' Reads a python file object like a Gio.InputStream, as far as
+	    DecodeScaledPixbuf needs it. Reads stop after "limit" bytes.
+	    The file objects in "closing" are closed along with it '''
+	def __init__(self, file_object, limit=None, closing=()):
+		self.file_object = file_object
+		self.limit = limit
+		self.closing = closing
 		
-	def load_metadata(self):
-		if self.metadata is None:
-			self.metadata = ImageMeta()
+	def read_bytes(self, count, cancellable=None):
+		if cancellable:
+			cancellable.set_error_if_cancelled()
+			
+		if self.limit is not None:
+			count = min(count, self.limit)
+			self.limit -= count
+			
+		return GLib.Bytes.new(self.file_object.read(count) if count else b"")
 		
-		# These file properties are queried from the file info
-		try:
-			file_info = self.gfile.query_info(
-			                       "standard::size,time::modified", 0, None)
+	def close(self, cancellable=None):
+		self.file_object.close()
+		for a_file_object in self.closing:
+			a_file_object.close()
 
+class GFileObject(io.RawIOBase):
+	''' A python file object for reading a Gio.File,
+	    for python modules that only read python file objects '''
+	SeekTypes = [GLib.SeekType.SET, GLib.SeekType.CUR, GLib.SeekType.END]
+	
+	def __init__(self, gfile):
+		super().__init__()
+		self.stream = gfile.read(None)
+		
+	def readable(self):
+		return True
+		
+	def seekable(self):
+		return self.stream.can_seek()
+		
+	def readinto(self, buffer):
+		some_bytes = self.stream.read_bytes(len(buffer), None).get_data()
+		buffer[:len(some_bytes)] = some_bytes
+		return len(some_bytes)
+		
+	def seek(self, offset, whence=io.SEEK_SET):
+		self.stream.seek(offset, GFileObject.SeekTypes[whence], None)
+		return self.stream.tell()
+		
+	def tell(self):
+		return self.stream.tell()
+		
+	def close(self):
+		if not self.closed:
+			self.stream.close(None)
+			
+		super().close()
+
+# "info" is the zipfile.ZipInfo of zip members and the data offset of
+# tar members
+ArchiveMember = collections.namedtuple("ArchiveMember",
+                                       ["name", "size", "mtime", "info"])
+
+class Archive:
+	''' A zip or tar archive. Its member list is read only once and its
+	    members can be read at the same time from several threads.
+	    The archive is only open while it is read, so that folders full
+	    of archives don't run out of file descriptors '''
+	def __init__(self, gfile):
+		self.gfile = gfile
+		self.fullname = gfile.get_parse_name()
+		self._is_zip = False
+		
+	def list_members(self):
+		''' Returns a list of the ArchiveMembers that are files.
+		    This blocks, so it should be called from a worker thread '''
+		file_object = self._open()
+		try:
+			if zipfile.is_zipfile(file_object):
+				# Reads just the central directory at the end of the file
+				self._is_zip = True
+				with zipfile.ZipFile(file_object) as zip_file:
+					return [ArchiveMember(an_info.filename,
+					                      an_info.file_size,
+					                      Archive._GetZipTime(an_info),
+					                      an_info)
+					        for an_info in zip_file.infolist()
+					        if not an_info.filename.endswith("/")]
+					        
+			else:
+				# Tar headers are spread along the file but the file data
+				# between them is skipped over
+				file_object.seek(0)
+				with tarfile.open(fileobj=file_object, mode="r:") as tar_file:
+					return [ArchiveMember(a_member.name, a_member.size,
+					                      a_member.mtime, a_member.offset_data)
+					        for a_member in tar_file if a_member.isfile()]
+					        
+		finally:
+			file_object.close()
+			
+	def open_member(self, member):
+		''' Opens a FileObjectStream for reading a member, closing it
+		    closes the archive too '''
+		file_object = self._open()
+		try:
+			if self._is_zip:
+				# The central directory is read again, it's small
+				zip_file = zipfile.ZipFile(file_object)
+				return FileObjectStream(zip_file.open(member.info),
+				                        closing=[zip_file, file_object])
+				                        
+			else:
+				# Tar members are not compressed, so they are read directly
+				file_object.seek(member.info)
+				return FileObjectStream(file_object, member.size)
+				
 		except Exception:
-			self.metadata.modification_date = float(time.time())
-			self.metadata.data_size = 0
+			file_object.close()
+			raise
+			
+	def _open(self):
+		if self.gfile.is_native():
+			return open(self.gfile.get_path(), "rb")
 			
 		else:
-			try:
-				size_str = file_info.get_attribute_as_string("standard::size")
-				self.metadata.data_size = int(size_str)
-			except Exception:
-				self.metadata.data_size = 0
+			return io.BufferedReader(GFileObject(self.gfile))
+			
+	@staticmethod
+	def _GetZipTime(info):
+		try:
+			return time.mktime(info.date_time + (0, 0, -1))
+			
+		except (OverflowError, ValueError):
+			return 0
+
+class ArchiveMemberImageNode(PixbufImageNode):
+	''' An image in an Archive, decoded from the archive
+	    without extracting it '''
+	def __init__(self, archive, member):
+		super().__init__()
+		self.archive = archive
+		self.member = member
+		
+		self.fullname = archive.fullname + "/" + member.name
+		self.name = posixpath.basename(member.name)
+		self.location = Location.Disk if archive.gfile.is_native() \
+		                              else Location.Distant
+		self.status = Status.Good
+		self.cancellable = None
+		# See PixbufFileImageNode.fit
+		self.fit = None
+		self._job = None
+		# The image size read from the member header
+		self._header_size = None
+		
+	def _priority_changed(self):
+		if self._job:
+			self._job.priority = self.priority
+			
+	def load(self):
+		if self.is_loading:
+			raise Exception
+			
+		self.cancellable = Gio.Cancellable()
+		self.status = Status.Loading
+		fit = self.fit
+		self._job = DecodingEngine.Default.submit(
+		                lambda job: self._decode(job, fit), self._loaded,
+		                self.cancellable, self.priority)
+		
+	def _decode(self, job, fit=None):
+		''' Reads and decodes the member, runs in a worker thread '''
+		job.size = self.member.size
+		stream = self.archive.open_member(self.member)
+		try:
+			limit = PixbufFileImageNode.DecodeLimit
+			pixbuf, image_size = DecodeScaledPixbuf(stream, fit, limit,
+			                                        job.cancellable)
+			
+		finally:
+			stream.close(None)
+			
+		return viewing.SurfaceFromPixbuf(pixbuf), image_size
+		
+	def _loaded(self, job):
+		# Results from jobs cancelled by unload are of no interest
+		if job is not self._job:
+			return
+			
+		self.cancellable = None
+		self._job = None
+		self.error = None
+		if job.error:
+			if self._surface:
+				# Failed to load it bigger, keep showing the smaller one
+				self.status = Status.Good
 				
-			try:
-				time_str = file_info.get_attribute_as_string("time::modified")
-				self.metadata.modification_date = float(time_str)
-			except Exception:
-				self.metadata.modification_date = float(time.time())
+			else:
+				self.location &= ~Location.Memory
+				self.status = Status.Bad
+				self.error = job.error
+				
+		else:
+			surface, image_size = job.result
+			if surface.get_width() < image_size[0]:
+				self.image_size = image_size
+				
+			else:
+				self.image_size = None
+				
+			self._refresh_frames(surface)
+			self.location |= Location.Memory
+			self.status = Status.Good
+			self.load_metadata()
+			
+		self.emit("finished-loading", self.error)
 		
-		# The width and height of the image are loaded from guess where
-		if self.animation:
-			self.metadata.width = self.animation.get_width()
-			self.metadata.height = self.animation.get_height()
+	def load_metadata(self):
+		if self.metadata is None:
+			self.metadata = ImageMeta()
+			
+		self.metadata.data_size = self.member.size
+		self.metadata.modification_date = float(self.member.mtime)
+		if self.image_size:
+			size = self.image_size
+			
+		elif self._surface:
+			size = self._surface.get_width(), self._surface.get_height()
+			
+		else:
+			size = self._header_size
+			if size is None:
+				# Reading the member would block
+				self.load_metadata_async()
+				
+		self.metadata.width, self.metadata.height = size or (0, 0)
+		
+	def load_metadata_async(self):
+		''' Reads the image size from the member header in a worker
+		    thread, emits "metadata-changed" once it's done '''
+		if self._metadata_job is None:
+			self._metadata_job = DecodingEngine.Default.submit(
+			                         self._probe_metadata,
+			                         self._metadata_probed,
+			                         priority=GLib.MAXINT)
 			
-		elif self.gfile.is_native():
+	def _probe_metadata(self, job):
+		''' Reads the image size, runs in a worker thread '''
+		try:
+			stream = self.archive.open_member(self.member)
 			try:
-				filepath = self.gfile.get_path()
-				fmt, width, height = GdkPixbuf.Pixbuf.get_file_info(filepath)
-				self.metadata.width = width
-				self.metadata.height = height
+				return None, ProbeStreamImageSize(stream, job.cancellable)
 				
-			except Exception:
-				self.metadata.width = 0
-				self.metadata.height = 0
+			finally:
+				stream.close(None)
+				
+		except Exception:
+			return None, None
 			
-		# TODO: Add support for non-native files
+	def _metadata_probed(self, job):
+		# Jobs replaced by ProbeMetadata are of no interest
+		if job is not self._metadata_job:
+			return
+			
+		self._metadata_job = None
+		self._apply_probed_metadata(job.result or (None, None))
+		self.emit("metadata-changed")
+		
+	def _apply_probed_metadata(self, result):
+		''' Sets the metadata from what _probe_metadata returned '''
+		self._header_size = result[1] or (0, 0)
+		self.load_metadata()
+		
+	def unload(self):
+		if self.cancellable:
+			self.cancellable.cancel()
+			self.cancellable = None
+			self._job = None
+			
+		PixbufImageNode.unload(self)
+		self.location &= ~Location.Memory
+		self.status = Status.Good
@@ -17,18 +17,22 @@
     You should have received a copy of the GNU General Public License
     along with Pynorama. If not, see <http://www.gnu.org/licenses/>. '''
     
-import os
+import bisect, os, time
 from gi.repository import GLib, GObject
-from collections import MutableSequence
-import utility
+from collections import MutableSequence, deque
+import loading, tasking, utility
 
 class Album(GObject.Object):
 	''' It organizes images '''
 	
+	# Splicing more images than this merges them into the album at once
+	SpliceInserts = 16
+	
 	__gsignals__ = {
 		"image-added" : (GObject.SIGNAL_RUN_FIRST, None, [object, int]),
 		"image-removed" : (GObject.SIGNAL_RUN_FIRST, None, [object, int]),
 		"order-changed" : (GObject.SIGNAL_RUN_FIRST, None, []),
+		"sort-progress" : (GObject.SIGNAL_RUN_FIRST, None, [int, int]),
 	}
 	def __init__(self):
 		GObject.GObject.__init__(self)
@@ -37,9 +41,17 @@ class Album(GObject.Object):
 		self.connect("notify::reverse", self.__queue_autosort)
 		self.connect("notify::autosort", self.__queue_autosort)
 		self.connect("notify::comparer", self.__queue_autosort)
+		self.connect("notify::reverse", self.forget_keys)
+		self.connect("notify::comparer", self.forget_keys)
 		
 		self._store = []
 		self.__autosort_signal_id = None
+		# The sorting keys of the images, ascending, see splice
+		self._sorted_keys = None
+		# Maps images to their index until the album changes, see index
+		self._positions = None
+		# Probes metadata for sorting, a tasking.Task
+		self.sorting = None
 		
 	# --- Mutable sequence interface down this line ---#
 	def __len__(self):
@@ -50,8 +62,10 @@ class Album(GObject.Object):
 		
 	def __setitem__(self, item, value):
 		self._store[item] = value
+		self._sorted_keys = self._positions = None
 		
 	def __delitem__(self, item):
+		self._sorted_keys = self._positions = None
 		if isinstance(item, slice):
 			indices = item.indices(len(self._store))
 			removed_indices = []
@@ -72,33 +86,176 @@ class Album(GObject.Object):
 			self.emit("image-removed", image, item)
 	
 	def insert(self, index, image):
+		self._sorted_keys = self._positions = None
 		self._store.insert(index, image)
 		self.emit("image-added", image, index)
 		self.__queue_autosort()
 	
+	def splice(self, images):
+		''' Inserts images where they belong in the order of the album,
+		    which should be sorted already, instead of sorting it again,
+		    so the images around the image in focus don't move around.
+		    The keys are computed once and kept for the next splice '''
+		if not self.comparer:
+			self.extend(images)
+			return
+			
+		if self._sorted_keys is None:
+			self._sorted_keys = sorted(map(self.comparer, self._store))
+			
+		images = list(images)
+		if len(images) > Album.SpliceInserts:
+			self._merge(images)
+			return
+			
+		for an_image in images:
+			key = self.comparer(an_image)
+			i = bisect.bisect_right(self._sorted_keys, key)
+			self._sorted_keys.insert(i, key)
+			if self.reverse:
+				i = len(self._sorted_keys) - 1 - i
+				
+			# Nothing needs sorting, so no autosort is queued
+			self._store.insert(i, an_image)
+			self._positions = None
+			self.emit("image-added", an_image, i)
+	
+	def _merge(self, images):
+		# Inserting images one by one moves the whole album for every
+		# image, instead the images are sorted and the album is copied
+		# once, in slices between where each image goes
+		new_keys = [self.comparer(an_image) for an_image in images]
+		order = sorted(range(len(images)), key=new_keys.__getitem__)
+		
+		old_keys = self._sorted_keys
+		old_images = self._store[::-1] if self.reverse else self._store
+		merged_keys, merged_images, added_indices = [], [], []
+		start = 0
+		for i in order:
+			key = new_keys[i]
+			end = bisect.bisect_right(old_keys, key, start)
+			merged_keys.extend(old_keys[start:end])
+			merged_images.extend(old_images[start:end])
+			start = end
+			
+			added_indices.append(len(merged_images))
+			merged_keys.append(key)
+			merged_images.append(images[i])
+			
+		merged_keys.extend(old_keys[start:])
+		merged_images.extend(old_images[start:])
+		if self.reverse:
+			merged_images.reverse()
+			last = len(merged_images) - 1
+			added_indices = [last - i for i in reversed(added_indices)]
+			
+		self._store = merged_images
+		self._sorted_keys = merged_keys
+		self._positions = None
+		# In ascending order every index is right for the album
+		# with only the images before it added
+		for i in added_indices:
+			self.emit("image-added", self._store[i], i)
+	
+	def forget_keys(self, *data):
+		''' Drops the sorting keys kept by splice, for when something
+		    the keys are made from changed '''
+		self._sorted_keys = None
+	
 	# --- "inheriting" down this line --- #
 	
-	__contains__ = MutableSequence.__contains__
 	__iter__ = MutableSequence.__iter__
 	__reversed__ = MutableSequence.__reversed__
 	
 	append = MutableSequence.append
 	count = MutableSequence.count
 	extend = MutableSequence.extend
-	index = MutableSequence.index
 	pop = MutableSequence.pop
 	remove = MutableSequence.remove
 	reverse = MutableSequence.reverse
 	
+	def __contains__(self, image):
+		return image in self._get_positions()
+		
+	def index(self, image):
+		''' Returns the index of an image, looked up in a map that is
+		    kept until the album changes, so looking up the images around
+		    the image in focus over and over doesn't go through the album '''
+		try:
+			return self._get_positions()[image]
+			
+		except KeyError:
+			raise ValueError("{} is not in the album".format(image))
+			
+	def _get_positions(self):
+		if self._positions is None:
+			# The first of repeated images wins
+			self._positions = {an_image: i for i, an_image
+			                   in reversed(list(enumerate(self._store)))}
+			
+		return self._positions
+		
 	def sort(self):
+		''' Sorts the album. Sorting by metadata first probes the metadata
+		    of every image missing it in worker threads, emitting
+		    "sort-progress", and then sorts once that is done '''
 		if self.__autosort_signal_id:
 			GLib.source_remove(self.__autosort_signal_id)
 			self.__autosort_signal_id = None
 		
+		if self.comparer in SortingKeys.Metadata:
+			if self.sorting:
+				# It sorts everything once it's done
+				return
+				
+			missing = self._get_missing_metadata()
+			if missing:
+				sorting = tasking.Task(self._sort_when_probed(missing))
+				if not sorting.done():
+					self.sorting = sorting
+					
+				return
+				
+		else:
+			self.stop_sorting()
+			
+		self._sort_now()
+		
+	def _sort_now(self):
+		# Nobody needs to know about sorting that moved nothing
+		old_order = list(self._store)
 		if self.sort_list(self._store):
-			self.emit("order-changed")
-	
+			self._sorted_keys = self._positions = None
+			if self._store != old_order:
+				self.emit("order-changed")
+	
+	def stop_sorting(self):
+		''' Stops probing metadata for sorting, leaving the album unsorted '''
+		if self.sorting:
+			self.sorting.cancel()
+			
+	def _get_missing_metadata(self):
+		return [an_image for an_image in self._store
+		                 if an_image.needs_metadata]
+		
+	def _sort_when_probed(self, missing):
+		try:
+			# Images can be added while the others are probed
+			while missing:
+				yield from loading.ProbeMetadata(missing, self._sort_progressed)
+				missing = self._get_missing_metadata()
+				
+		finally:
+			self.sorting = None
+			
+		self._sort_now()
+			
+	def _sort_progressed(self, probed, total):
+		self.emit("sort-progress", probed, total)
+		
 	def sort_list(self, a_list):
+		''' Sorts a list of images, the key of every image is
+		    computed only once '''
 		if self.comparer and len(a_list) > 1:
 			a_list.sort(key=self.comparer, reverse=self.reverse)
 			return True
@@ -108,12 +265,12 @@ class Album(GObject.Object):
 	
 	def next(self, image):
 		''' Returns the image after the input '''
-		index = self._store.index(image)
+		index = self.index(image)
 		return self._store[(index + 1) % len(self._store)]
 		
 	def previous(self, image):
 		''' Returns the image before the input '''
-		index = self._store.index(image)
+		index = self.index(image)
 		return self._store[(index - 1) % len(self._store)]		
 	
 	def around(self, image, forward, backwards):
@@ -122,7 +279,7 @@ class Album(GObject.Object):
 		    This method cycles around the list '''
 		result = []
 		if forward or backwards:
-			start = self._store.index(image)
+			start = self.index(image)
 			count = len(self._store)
 		
 			for i in range(1, 1 + forward):
@@ -180,6 +337,12 @@ class SortingKeys:
 		ByFileSize, ByFileDate,
 		ByImageSize, ByImageWidth, ByImageHeight
 	]
+	
+	# Keys that need the metadata of the images
+	Metadata = {
+		ByFileSize, ByFileDate,
+		ByImageSize, ByImageWidth, ByImageHeight
+	}
 
 from gi.repository import Gtk, Gio
 from gettext import gettext as _
@@ -201,6 +364,9 @@ class AlbumViewLayout(GObject.Object):
 		
 		self.connect("notify::layout", self._layout_changed)
 		
+		self.predictor = NavigationPredictor(self)
+		self.connect("notify::album", self._album_changed)
+		
 		self.layout = layout
 		self.album = album
 		self.view = view
@@ -221,11 +387,18 @@ class AlbumViewLayout(GObject.Object):
 	
 	def go_next(self):
 		self.__old_layout.go_next(self)
+		self.predictor.navigated(1)
 	
 	def go_previous(self):
 		self.__old_layout.go_previous(self)
+		self.predictor.navigated(-1)
+	
+	def get_prefetch_start(self, forward):
+		return self.__old_layout.get_prefetch_start(self, forward)
 	
 	def clean(self):
+		# Stop prefetching so the images it used can be unloaded
+		self.predictor.clear()
 		if not self.__is_clean:
 			self.__old_layout.clean(self)
 			self.__is_clean = True
@@ -244,10 +417,153 @@ class AlbumViewLayout(GObject.Object):
 			self.layout.subscribe(self)
 			self.go_image(focus_image)
 		
+	def _album_changed(self, *data):
+		self.predictor.clear()
+		
 	album = GObject.property(type=object, default=None)
 	view = GObject.property(type=object, default=None)
 	layout = GObject.property(type=object, default=None)
 	
+class NavigationPredictor:
+	''' Guesses where the user is heading in the album of an avl from how
+	    fast and which way they go to the next and previous images or pan
+	    through a layout, and prefetches the images ahead of them by using
+	    them. The faster they move, the more images are prefetched '''
+	
+	# Seconds of motion the velocity is averaged over
+	Window = 1.0
+	# Images that would be reached in this many seconds are prefetched
+	Lookahead = 1.5
+	MaxLookahead = 12
+	# Offset changes right after navigating come from the layout
+	# aligning the view to the new image, not from the user panning
+	NavigationGrace = 0.15
+	# Images per second above which the user is just flying past images
+	# and seconds without moving after which they settled on one.
+	# A dwell of zero means never flying past images
+	RapidRate = 4
+	RapidDwell = 0.25
+	# Seconds between prefetching updates while panning, since the view
+	# offset changes for every motion event
+	PanInterval = 0.1
+	
+	def __init__(self, avl):
+		self.avl = avl
+		self.prefetched_images = []
+		self._motions = deque()
+		self._navigation_time = 0
+		self._motion_time = 0
+		self._timeout_id = None
+		self._pan_timeout_id = None
+		
+	def navigated(self, step):
+		''' Tells the predictor the user went step images forward '''
+		self._navigation_time = time.monotonic()
+		self._add_motion(step)
+		
+	def panned(self, images):
+		''' Tells the predictor the user panned some images forward,
+		    which can be a fraction or negative for going backward '''
+		if time.monotonic() - self._navigation_time > \
+		   NavigationPredictor.NavigationGrace:
+			self._add_motion(images, throttle=True)
+			
+	def get_velocity(self):
+		''' Returns how many images per second the user is moving forward '''
+		now = time.monotonic()
+		while self._motions and \
+		      now - self._motions[0][0] > NavigationPredictor.Window:
+			self._motions.popleft()
+			
+		return sum(images for t, images in self._motions) \
+		       / NavigationPredictor.Window
+		
+	def is_rapid(self):
+		''' Returns whether the user is going through images too fast
+		    to look at them and didn't settle on one yet '''
+		dwell = NavigationPredictor.RapidDwell
+		if not dwell or time.monotonic() - self._motion_time >= dwell:
+			return False
+			
+		return abs(self.get_velocity()) >= NavigationPredictor.RapidRate
+		
+	def update(self):
+		''' Prefetches the images ahead of the user '''
+		velocity = self.get_velocity()
+		lookahead = min(round(abs(velocity) * NavigationPredictor.Lookahead),
+		                NavigationPredictor.MaxLookahead)
+		
+		new_images = []
+		album = self.avl.album
+		if lookahead and album:
+			forward = velocity > 0
+			start_image = self.avl.get_prefetch_start(forward)
+			focus_image = self.avl.focus_image
+			if start_image in album:
+				if forward:
+					ahead_images = album.around(start_image, lookahead, 0)
+				else:
+					ahead_images = album.around(start_image, 0, lookahead)
+					
+				for an_image in ahead_images:
+					if an_image is focus_image or an_image in new_images:
+						break # Went around the whole album
+						
+					new_images.append(an_image)
+					
+		# Use the new images first so the old ones are not unused
+		# and then requested again
+		for an_image in new_images:
+			an_image.uses += 1
+			
+		for an_image in self.prefetched_images:
+			an_image.uses -= 1
+			
+		self.prefetched_images = new_images
+		
+		# Check again once the motion is over to stop prefetching
+		if new_images and self._timeout_id is None:
+			self._timeout_id = GLib.timeout_add(
+			                       int(NavigationPredictor.Window * 1000),
+			                       self._motion_timeout)
+			
+	def clear(self):
+		''' Forgets the motion and stops prefetching '''
+		self._motions.clear()
+		if self._timeout_id is not None:
+			GLib.source_remove(self._timeout_id)
+			self._timeout_id = None
+			
+		if self._pan_timeout_id is not None:
+			GLib.source_remove(self._pan_timeout_id)
+			self._pan_timeout_id = None
+			
+		for an_image in self.prefetched_images:
+			an_image.uses -= 1
+			
+		self.prefetched_images = []
+		
+	def _add_motion(self, images, throttle=False):
+		self._motion_time = time.monotonic()
+		self._motions.append((self._motion_time, images))
+		if not throttle:
+			self.update()
+			
+		elif self._pan_timeout_id is None:
+			self._pan_timeout_id = GLib.timeout_add(
+			                   int(NavigationPredictor.PanInterval * 1000),
+			                   self._pan_timeout)
+			
+	def _pan_timeout(self):
+		self._pan_timeout_id = None
+		self.update()
+		return False
+		
+	def _motion_timeout(self):
+		self._timeout_id = None
+		self.update()
+		return False
+		
 class AlbumLayout:
 	''' Places images from an album into a view '''
 	def __init__(self):
@@ -311,6 +627,12 @@ class AlbumLayout:
 		previous_image = avl.album.previous(focus)
 		avl.go_image(previous_image)		
 		
+	
+	def get_prefetch_start(self, avl, forward):
+		''' Returns the image after or before which the images the
+		    user is heading to are prefetched '''
+		return avl.focus_image
+		
 
 	def start(self, avl):
 		''' Set any initial variables in an AlbumViewLayout '''
@@ -349,6 +671,11 @@ class AlbumLayout:
 class SingleImageLayout(AlbumLayout):
 	''' Places a single album image in a view '''
 	
+	# The loading icon surface, loaded when it's first shown,
+	# None if it couldn't be loaded
+	_Placeholder = None
+	_PlaceholderLoaded = False
+	
 	def __init__(self):
 		AlbumLayout.__init__(self)
 		self.source_option = SingleImageLayout.Option
@@ -358,6 +685,7 @@ class SingleImageLayout(AlbumLayout):
 		avl.current_image = None
 		avl.current_frame = None
 		avl.load_handle = None
+		avl.preview_handle = None
 		avl.old_album = None
 		avl.removed_signal_id = None
 		avl.album_notify_id = avl.connect(
@@ -369,6 +697,10 @@ class SingleImageLayout(AlbumLayout):
 			avl.current_image.disconnect(avl.load_handle)
 		del avl.load_handle
 		
+		if avl.preview_handle:
+			avl.current_image.disconnect(avl.preview_handle)
+		del avl.preview_handle
+		
 		if avl.current_image:
 			avl.current_image.uses -= 1
 		del avl.current_image
@@ -405,6 +737,10 @@ class SingleImageLayout(AlbumLayout):
 				previous_image.disconnect(avl.load_handle)
 				avl.load_handle = None
 				
+			if avl.preview_handle:
+				previous_image.disconnect(avl.preview_handle)
+				avl.preview_handle = None
+				
 		if target_image is None:
 			# Current image being none means nothing is displayed #
 			self._refresh_frame(avl)
@@ -417,9 +753,53 @@ class SingleImageLayout(AlbumLayout):
 			else:
 				avl.load_handle = avl.current_image.connect(
 				                  "finished-loading", self._image_loaded, avl)
+				                  
+				# Show a preview of the image while it loads
+				if target_image.has_preview:
+					self._refresh_frame(avl)
+					
+				else:
+					# Don't keep showing images that were flown past
+					if avl.predictor.is_rapid():
+						self._show_placeholder(avl)
+						
+					avl.preview_handle = target_image.connect(
+					                 "preview-changed", self._preview_changed,
+					                 avl)
 		
 		avl.emit("focus-changed", avl.current_image, False)
 		
+	def _show_placeholder(self, avl):
+		# Shows a loading icon until there is something else to show
+		icon_surface = SingleImageLayout._GetPlaceholder()
+		if icon_surface is None:
+			return
+			
+		if avl.current_frame:
+			avl.view.remove_frame(avl.current_frame)
+			
+		avl.current_frame = viewing.ImageSurfaceFrame(icon_surface)
+		avl.view.add_frame(avl.current_frame)
+		avl.view.align_to_frame(avl.current_frame)
+		
+	@staticmethod
+	def _GetPlaceholder():
+		# It's shown for every image flown past, so it's loaded only once
+		if not SingleImageLayout._PlaceholderLoaded:
+			SingleImageLayout._PlaceholderLoaded = True
+			try:
+				icon = Gtk.IconTheme.get_default().load_icon(
+				           "image-loading", 64, 0)
+				           
+			except GLib.Error:
+				pass
+				
+			else:
+				SingleImageLayout._Placeholder = \
+				                  viewing.SurfaceFromPixbuf(icon)
+				
+		return SingleImageLayout._Placeholder
+		
 	def _refresh_frame(self, avl):
 		if avl.current_frame:
 			avl.view.remove_frame(avl.current_frame)
@@ -468,6 +848,13 @@ class SingleImageLayout(AlbumLayout):
 	
 	def _image_loaded(self, image, error, avl):
 		self._refresh_frame(avl)
+		
+	def _preview_changed(self, image, avl):
+		image.disconnect(avl.preview_handle)
+		avl.preview_handle = None
+		
+		if not image.on_memory and image.has_preview:
+			self._refresh_frame(avl)
 
 
 class LayoutDirection:
@@ -534,6 +921,8 @@ class ImageStripLayout(GObject.Object, AlbumLayout):
 		avl.shown_images, avl.shown_frames = [], []
 		avl.space_before = avl.space_after = 0
 		avl.load_handles = {}
+		avl.preview_handles = {}
+		avl.pan_position = None
 		
 		avl.old_view = avl.old_album = None
 		
@@ -563,10 +952,14 @@ class ImageStripLayout(GObject.Object, AlbumLayout):
 		for an_image, a_handle_id in avl.load_handles.items():
 			an_image.disconnect(a_handle_id)				
 		
+		for an_image, a_handle_id in avl.preview_handles.items():
+			an_image.disconnect(a_handle_id)
+			
 		del avl.center_image, avl.center_frame
 		del avl.shown_images, avl.shown_frames
 		del avl.space_before, avl.space_after
-		del avl.load_handles
+		del avl.load_handles, avl.preview_handles
+		del avl.pan_position
 		
 		for signal_id in avl.notify_signals:
 			avl.disconnect(signal_id)
@@ -589,6 +982,14 @@ class ImageStripLayout(GObject.Object, AlbumLayout):
 	def get_focus_image(self, avl):
 		return avl.center_image
 	
+	def get_prefetch_start(self, avl, forward):
+		# The images shown at the sides are already loaded
+		if avl.shown_images:
+			return avl.shown_images[-1 if forward else 0]
+			
+		else:
+			return avl.center_image
+	
 	def get_focus_frame(self, avl):
 		return avl.center_frame
 		
@@ -648,6 +1049,7 @@ class ImageStripLayout(GObject.Object, AlbumLayout):
 			return
 			
 		self._clear_images(avl)
+		avl.pan_position = None
 		avl.center_index = avl.center_image = avl.center_frame = None
 		self._insert_image(avl, 0, image)
 	
@@ -750,6 +1152,7 @@ class ImageStripLayout(GObject.Object, AlbumLayout):
 		''' This checks whether an offset change in the view, caused by
 		    panning for example, was big enough to change the focus image '''
 		    
+		self._track_pan(avl)
 		if avl.center_frame and not view.frames_fit:
 			w, h = avl.view.get_widget_size()
 			tl = avl.view.get_absolute_point((0, 0))
@@ -804,6 +1207,24 @@ class ImageStripLayout(GObject.Object, AlbumLayout):
 						avl.emit("focus-changed", best_image, True)
 
 
+	def _track_pan(self, avl):
+		# Tells the navigation predictor how many images were panned
+		w, h = avl.view.get_widget_size()
+		x, y = avl.view.get_absolute_point((w / 2, h / 2))
+		axis_x, axis_y = ImageStripLayout.DirectionAxes[self.direction]
+		position = x * axis_x + y * axis_y
+		
+		if avl.pan_position is not None and position != avl.pan_position:
+			lengths = [self._get_length(a_frame) for a_frame \
+			           in avl.shown_frames if a_frame]
+			if lengths:
+				image_length = sum(lengths) / len(lengths) + self.margin_after
+				if image_length > 0:
+					panned_images = (position - avl.pan_position) / image_length
+					avl.predictor.panned(panned_images)
+					
+		avl.pan_position = position
+		
 	def _alignment_changed(self, view, data, avl):
 		if not self.own_alignment:
 			self._reposition_frames(avl)
@@ -909,6 +1330,10 @@ class ImageStripLayout(GObject.Object, AlbumLayout):
 			load_handle_id = avl.load_handles.pop(image, None)
 			if load_handle_id:
 				image.disconnect(load_handle_id)
+				
+			preview_handle_id = avl.preview_handles.pop(image, None)
+			if preview_handle_id:
+				image.disconnect(preview_handle_id)
 		
 		if avl.center_image and index < avl.center_index:
 			# Decrement the center index because a frame was removed before it
@@ -936,12 +1361,33 @@ class ImageStripLayout(GObject.Object, AlbumLayout):
 				                               self._image_loaded, avl)
 				avl.load_handles[image] = load_handle_id
 				
+			# Show a preview of the image while it loads
+			if image.has_preview:
+				self._refresh_frames(avl, image)
+				avl.update_sides.queue()
+				
+			elif image not in avl.preview_handles:
+				avl.preview_handles[image] = image.connect(
+				                             "preview-changed",
+				                             self._preview_changed, avl)
+				
 	def _image_loaded(self, image, error, avl):
 		load_handle_id = avl.load_handles.pop(image, None)
 		if load_handle_id:
 			image.disconnect(load_handle_id)
 			
 		if image in avl.shown_images:
+			# Frames showing a preview only get their surface replaced
+			self._refresh_frames(avl, image, overwrite=image.is_bad)
+			avl.update_sides.queue()
+			
+	def _preview_changed(self, image, avl):
+		preview_handle_id = avl.preview_handles.pop(image, None)
+		if preview_handle_id:
+			image.disconnect(preview_handle_id)
+			
+		if image in avl.shown_images and \
+		   not image.on_memory and image.has_preview:
 			self._refresh_frames(avl, image)
 			avl.update_sides.queue()
 	
@@ -1115,6 +1561,8 @@ class ImageStripLayout(GObject.Object, AlbumLayout):
 		if new_frame is not old_frame:
 			if old_frame:
 				avl.view.remove_frame(old_frame)
+				if old_frame is avl.center_frame:
+					avl.center_frame = new_frame
 			
 			avl.shown_frames[index] = new_frame
 			if new_frame:
@@ -1232,6 +1680,14 @@ class ImageStripLayout(GObject.Object, AlbumLayout):
 		dist_b = abs(rect.top + rect.height - center)
 		return dist_a * (1 - ay) + dist_b * ay
 			
+	# Which way is forward in the absolute coordinates of the view
+	DirectionAxes = {
+		LayoutDirection.Right : (1, 0),
+		LayoutDirection.Left : (-1, 0),
+		LayoutDirection.Up : (0, -1),
+		LayoutDirection.Down : (0, 1)
+	}
+	
 	DirectionMethods = {
 		LayoutDirection.Right : (_GetFrameWidth, _GetHorizontalRectDistance,
 		                         _CoordinateToLeft, _CoordinateToRight),
@@ -1243,13 +1699,23 @@ class ImageStripLayout(GObject.Object, AlbumLayout):
 		                        _CoordinateToTop, _CoordinateToBottom)
 	}
 	
-	# TODO: Get another ID for this
-	Preferences = Gio.Settings("com.example.pynorama.layouts.image-strip")
+	# Created when first needed, see GetPreferences
+	_Preferences = None
+	
+	@staticmethod
+	def GetPreferences():
+		''' Returns the Gio.Settings of the layout '''
+		if ImageStripLayout._Preferences is None:
+			# TODO: Get another ID for this
+			ImageStripLayout._Preferences = Gio.Settings(
+			                   "com.example.pynorama.layouts.image-strip")
+			                   
+		return ImageStripLayout._Preferences
 
 	@staticmethod
 	def FromPreferences():
 		''' Creates a ImageStripLayout with the preferred values '''
-		preferences = ImageStripLayout.Preferences
+		preferences = ImageStripLayout.GetPreferences()
 		loop_mode = preferences.get_enum("appearance-loop-mode")
 		direction_value = preferences.get_enum("appearance-direction")
 		kwargs = {
@@ -1271,7 +1737,7 @@ class ImageStripLayout(GObject.Object, AlbumLayout):
 
 
 	def save_preferences(self):
-		preferences = ImageStripLayout.Preferences
+		preferences = ImageStripLayout.GetPreferences()
 		preferences.set_boolean("appearance-own-alignment", self.own_alignment)
 		preferences.set_double("appearance-alignment", self.alignment)
 		
@@ -19,7 +19,8 @@
 from gi.repository import Gio, GLib, Gtk, Gdk, GObject
 from gettext import gettext as _
 import cairo, math, os
-import extending, organization, notification, utility
+import caching, extending, loading, organization, notification, utility
+import viewing
 
 Settings = Gio.Settings("com.example.pynorama")
 Directory = "preferences"
@@ -603,6 +604,38 @@ def LoadForApp(app):
 	app.zoom_effect = Settings.get_double("zoom-effect")
 	app.spin_effect = Settings.get_int("rotation-effect")
 	
+	decoder = loading.DecodingEngine.Default
+	decoder.workers = Settings.get_int("decoding-workers")
+	app.memory.budget = Settings.get_int("memory-budget") * 1024 * 1024
+	app.decode_for_display = Settings.get_boolean("decode-for-display")
+	# Images that could never fit in the budget are decoded smaller,
+	# but only if they are decoded again for display when zooming in
+	if app.decode_for_display:
+		loading.PixbufFileImageNode.DecodeLimit = app.memory.budget
+		
+	else:
+		loading.PixbufFileImageNode.DecodeLimit = 0
+		
+	# Longer animations are converted again as they play
+	viewing.AnimationPlayer.CacheLimit = app.memory.budget // 4
+	app.watch_directories = Settings.get_boolean("watch-directories")
+	dwell = Settings.get_int("rapid-navigation-dwell")
+	organization.NavigationPredictor.RapidDwell = dwell / 1000
+	use_thumbnails = Settings.get_boolean("use-thumbnails")
+	loading.PixbufFileImageNode.UseThumbnails = use_thumbnails
+	progressive = Settings.get_boolean("progressive-loading")
+	loading.PixbufFileImageNode.Progressive = progressive
+	
+	transfers = loading.DecodingEngine.Transfers
+	transfers.group_limit = Settings.get_int("transfers-per-host")
+	file_cache_size = Settings.get_int("file-cache-size")
+	caching.FileCache.Default.limit = file_cache_size * 1024 * 1024
+	share_duplicates = Settings.get_boolean("share-duplicates")
+	caching.ContentIndex.Default.enabled = share_duplicates
+	
+def LoadMouseHandlersForApp(app):
+	''' Loads the mouse handlers, which is deferred to after starting up.
+	    Returns False so that it can be used as an idle callback '''
 	try:
 		navigators_path = os.path.join(Directory, "navigators.xml")
 		if not os.path.exists(navigators_path):
@@ -614,6 +647,10 @@ def LoadForApp(app):
 	except Exception:
 		notification.log_exception("Couldn't load mouse handler preferences")
 		
+	else:
+		app.mouse_handlers_loaded = True
+		
+	return False
 		
 def SaveFromApp(app):
 	Settings.set_double("zoom-effect", app.zoom_effect)
@@ -625,6 +662,10 @@ def SaveFromApp(app):
 	except FileExistsError:
 		pass
 	
+	# Don't overwrite the preferences with handlers that were never loaded
+	if not app.mouse_handlers_loaded:
+		return
+		
 	try:
 		navigators_path = os.path.join(Directory, "navigators.xml")
 		SaveFromMouseHandler(app.meta_mouse_handler, navigators_path)
@@ -18,12 +18,16 @@
     You should have received a copy of the GNU General Public License
     along with Pynorama. If not, see <http://www.gnu.org/licenses/>. '''
 
-import gc, math, random, os, sys
+import collections, gc, math, random, os, sys, time
+# Startup is profiled from here, see utility.StartupProfile
+StartupTime = time.perf_counter()
+
 from gi.repository import Gtk, Gdk, GdkPixbuf, Gio, GLib, GObject
 import cairo
 from gettext import gettext as _
 import extending, utility
 import organization, mousing, loading, preferences, viewing, notification
+import caching
 from viewing import ZoomMode
 from loading import DirectoryLoader
 DND_URI_LIST, DND_IMAGE = range(2)
@@ -32,50 +36,83 @@ class ImageViewer(Gtk.Application):
 	Version = "v0.2.3"
 		
 	def __init__(self):
+		self.startup_profile = utility.StartupProfile(StartupTime)
+		self.startup_profile.mark("Importing modules")
+		
 		Gtk.Application.__init__(self)
 		self.set_flags(Gio.ApplicationFlags.HANDLES_OPEN)
+		self.add_main_option("startup-profile", 0, GLib.OptionFlags.NONE,
+		                     GLib.OptionArg.NONE,
+		                     _("Print how long each phase of "
+		                       "starting up takes"), None)
 		
 		# Default prefs stuff
 		self._preferences_dialog = None
 		self.memory_check_queued = False
+		self.loading_stuff = set()
+		# Things requested while flying past images, see memory_check
+		self.deferred_stuff = set()
+		self._deferred_check_source = None
+		self.decode_for_display = False
+		self.watch_directories = False
+		# Maps albums to the DirectoryWatches for them, by directory uri
+		self.directory_watches = dict()
 		self.meta_mouse_handler = mousing.MetaMouseHandler()
 		self.meta_mouse_handler.connect("handler-removed",
 		                                self._removed_mouse_handler)
 		self.mouse_handler_dialogs = dict()
+		# Set by preferences.LoadMouseHandlersForApp
+		self.mouse_handlers_loaded = False
 		
 		
 	# --- Gtk.Application interface down this line --- #
+	def do_handle_local_options(self, options):
+		if options.contains("startup-profile"):
+			self.startup_profile.enabled = True
+			
+		else:
+			self.startup_profile.finish()
+			
+		# Keep going as usual
+		return -1
+		
+		
 	def do_startup(self):
 		Gtk.Application.do_startup(self)
 		
+		self.memory = loading.Memory()
 		preferences.LoadForApp(self)
 		
-		self.memory = loading.Memory()
 		self.memory.connect("thing-requested", self.queue_memory_check)
 		self.memory.connect("thing-unused", self.queue_memory_check)
 		self.memory.connect("thing-unlisted", self.queue_memory_check)
+		self.memory.connect("thing-loaded", self.queue_memory_check)
+		self.memory.connect("thing-finished", self.log_loading_finish)
 			
 		Gtk.Window.set_default_icon_name("pynorama")
+		
+		# Mouse handlers are of no use before the first window shows up
+		GLib.idle_add(preferences.LoadMouseHandlersForApp, self)
+		self.startup_profile.mark("Starting up")
 	
 	
 	def do_activate(self):
 		some_window = self.get_window()
 		some_window.present()
+		self._report_startup_profile(some_window, False)
 	
 	
 	def do_open(self, files, file_count, hint):
 		some_window = self.get_window()
 		
-		some_window.go_new = True
-		self.open_files_for_album(some_window.album, files=files,
-		                          search=file_count == 1)
-		some_window.go_new = False
-		
+		some_window.open_files(files=files, search=file_count == 1)
 		some_window.present()
+		self._report_startup_profile(some_window, True)
 	
 	
 	def do_shutdown(self):
 		preferences.SaveFromApp(self)
+		caching.MetadataCache.Default.commit()
 		Gtk.Application.do_shutdown(self)
 	
 	
@@ -227,9 +264,70 @@ class ImageViewer(Gtk.Application):
 			
 			fillscreen = preferences.Settings.get_boolean("start-fullscreen")
 			a_window.set_fullscreen(fillscreen)
+			self.startup_profile.mark("Creating a window")
 			return a_window
 			
 			
+	def _report_startup_profile(self, window, wait_for_image):
+		''' Reports the startup profile, if enabled, once the window draws
+		    for the first time. If wait_for_image, that is after the first
+		    image in focus finishes loading, or fails to '''
+		profile = self.startup_profile
+		if not profile.enabled:
+			profile.finish()
+			return
+			
+		# Only the first window is profiled
+		profile.enabled = False
+		handlers = []
+		def disconnect():
+			while handlers:
+				an_object, an_id = handlers.pop()
+				an_object.disconnect(an_id)
+				
+		def frame_drawn(*data):
+			disconnect()
+			profile.mark("Drawing the first frame")
+			profile.report()
+			profile.finish()
+			
+		def wait_for_frame():
+			handlers.append((window.view,
+			                 window.view.connect_after("draw", frame_drawn)))
+			window.view.queue_draw()
+			
+		def image_finished(image, error):
+			disconnect()
+			if error:
+				profile.mark("Failing to load the first image")
+				
+			else:
+				profile.mark("Loading the first image")
+				
+			wait_for_frame()
+			
+		def focus_changed(avl, image, hint):
+			# Files are opened asynchronously, they are open
+			# once there is an image to focus
+			if image is None:
+				return
+				
+			disconnect()
+			profile.mark("Opening files")
+			if image.on_memory or image.is_bad:
+				image_finished(image, image.error)
+				
+			else:
+				handlers.append((image, image.connect("finished-loading",
+				                                      image_finished)))
+				
+		if wait_for_image:
+			handlers.append((window.avl, window.avl.connect("focus-changed",
+			                                                focus_changed)))
+		else:
+			wait_for_frame()
+			
+			
 	def queue_memory_check(self, *data):
 		if not self.memory_check_queued:
 			self.memory_check_queued = True
@@ -238,39 +336,176 @@ class ImageViewer(Gtk.Application):
 			
 	def memory_check(self):
 		self.memory_check_queued = False
-		
-		while self.memory.enlisted_stuff:
-			enlisted_thing = self.memory.enlisted_stuff.pop()
-			enlisted_thing.connect("finished-loading", self.log_loading_finish)
+		self.loading_stuff = {a_thing for a_thing in self.loading_stuff
+		                              if a_thing.is_loading}
+		
+		# Loading is logged by log_loading_finish
+		self.memory.enlisted_stuff.clear()
+		
+		unloaded_stuff = False
+		while self.memory.unlisted_stuff:
+			unlisted_thing = self.memory.unlisted_stuff.pop()
+			if self.memory.unload(unlisted_thing):
+				notification.log(notification.Lines.Unloaded(unlisted_thing))
+				unloaded_stuff = True
 				
-		if self.memory.unlisted_stuff or self.memory.unused_stuff:
-			while self.memory.unlisted_stuff:
-				unlisted_thing = self.memory.unlisted_stuff.pop()
-				if unlisted_thing.is_loading or unlisted_thing.on_memory:
-					unlisted_thing.unload()
-					notification.log(notification.Lines.Unloaded(unlisted_thing))
+		while self.memory.unused_stuff:
+			unused_thing = self.memory.unused_stuff.pop()
+			# Do not unload things that are not on disk (like pastes)
+			if unused_thing.on_disk:
+				if unused_thing.is_loading:
+					self.memory.unload(unused_thing)
+					notification.log(notification.Lines.Unloaded(unused_thing))
 					
-			while self.memory.unused_stuff:
-				unused_thing = self.memory.unused_stuff.pop()
-				# Do not unload things that are not on disk (like pastes)
-				if unused_thing.on_disk:
-					if unused_thing.is_loading or unused_thing.on_memory:
-						unused_thing.unload()
-						notification.log(notification.Lines.Unloaded(unused_thing))
-						
+				elif unused_thing.on_memory:
+					# Keep it around in case the user goes back to it
+					self.memory.deactivate(unused_thing)
+					
+		for requested_thing in self.memory.requested_stuff:
+			self.memory.activate(requested_thing)
+			
+		for collected_thing in self.memory.collect():
+			notification.log(notification.Lines.Unloaded(collected_thing))
+			unloaded_stuff = True
+			
+		if unloaded_stuff:
 			gc.collect()
 			
-		while self.memory.requested_stuff:
-			requested_thing = self.memory.requested_stuff.pop()
-			if not (requested_thing.is_loading or requested_thing.on_memory):
-				requested_thing.load()
-				notification.log(notification.Lines.Loading(requested_thing))
+		requested_stuff = [a_thing for a_thing in self.memory.requested_stuff
+		                           if not (a_thing.is_loading or
+		                                   a_thing.on_memory)]
+		self.memory.requested_stuff.clear()
+		
+		# Images the user is flying past are not decoded, only their
+		# previews are loaded until they settle on one
+		if requested_stuff and self.is_navigating_rapidly():
+			deferred_stuff = [a_thing for a_thing in requested_stuff
+			                          if not hasattr(a_thing, "source")]
+			self.deferred_stuff.update(deferred_stuff)
+			requested_stuff = [a_thing for a_thing in requested_stuff
+			                           if hasattr(a_thing, "source")]
+			if self._deferred_check_source is None:
+				dwell = organization.NavigationPredictor.RapidDwell
+				self._deferred_check_source = GLib.timeout_add(
+				                                  int(dwell * 1000),
+				                                  self._deferred_check)
+				                                  
+		# Loads that already started are ranked again since focus may change
+		self.loading_stuff.update(requested_stuff)
+		self.rank_loads(self.loading_stuff)
+		
+		self.fit_loads(requested_stuff)
+		requested_stuff.sort(key=lambda a_thing: a_thing.priority)
+		for requested_thing in requested_stuff:
+			requested_thing.load()
+			notification.log(notification.Lines.Loading(requested_thing))
+			
+		return False
+		
+		
+	def is_navigating_rapidly(self):
+		''' Returns whether the user is flying past images in any window '''
+		for a_window in self.get_windows():
+			avl = getattr(a_window, "avl", None)
+			if avl and avl.predictor.is_rapid():
+				return True
+				
+		return False
+		
+		
+	def _deferred_check(self):
+		if self.is_navigating_rapidly():
+			return True # Check again after another dwell
+			
+		self._deferred_check_source = None
+		# Only what is still used after settling is loaded
+		for a_thing in self.deferred_stuff:
+			if a_thing.uses > 0:
+				self.memory.requested_stuff.add(a_thing)
 				
+		self.deferred_stuff.clear()
+		self.queue_memory_check()
 		return False
 		
 		
-	def log_loading_finish(self, thing, error):
-		if error:
+	def rank_loads(self, stuff):
+		''' Sets the priority of each thing to its distance from the closest
+		    focused image in any window so that the images the user is
+		    looking at are loaded before the ones that are prefetched.
+		    Previews are ranked along with their source, right before it '''
+		sources = {getattr(a_thing, "source", a_thing) for a_thing in stuff}
+		distances = dict()
+		for a_window in self.get_windows():
+			avl = getattr(a_window, "avl", None)
+			focus_image = avl.focus_image if avl else None
+			if not stuff or focus_image is None:
+				continue
+				
+			album = avl.album
+			count = len(album)
+			try:
+				start = album.index(focus_image)
+				
+			except ValueError:
+				continue # The focus image was just removed
+				
+			# Album indices are looked up in a map, only what is
+			# ranked is looked at, not the whole album
+			for an_image in sources:
+				try:
+					i = album.index(an_image)
+					
+				except ValueError:
+					continue
+					
+				# Albums cycle around so the distance does too
+				distance = abs(i - start)
+				distance = min(distance, count - distance)
+				if distance < distances.get(an_image, GLib.MAXINT):
+					distances[an_image] = distance
+					
+		for a_thing in stuff:
+			source = getattr(a_thing, "source", None)
+			if source is None:
+				distance = distances.get(a_thing, GLib.MAXINT // 2)
+				a_thing.priority = distance * 2
+				
+			else:
+				distance = distances.get(source, GLib.MAXINT // 2)
+				a_thing.priority = distance * 2 - 1
+			
+			
+	def fit_loads(self, stuff):
+		''' Sets the view size and zoom mode things are shown with so that
+		    they are decoded at the size they are displayed at '''
+		stuff = [a_thing for a_thing in stuff if hasattr(a_thing, "fit")]
+		fits = dict()
+		if self.decode_for_display and stuff:
+			for a_window in self.get_windows():
+				if not hasattr(a_window, "avl"):
+					continue
+					
+				window_fit = a_window.get_decoding_fit()
+				for a_thing in stuff:
+					if a_thing in a_window.album:
+						fits.setdefault(a_thing, []).append(window_fit)
+						
+		for a_thing in stuff:
+			some_fits = fits.get(a_thing, [None])
+			if None in some_fits:
+				# Some window shows it at its actual size
+				a_thing.fit = None
+				
+			else:
+				# Fit the biggest view showing it
+				a_thing.fit = max(some_fits, key=lambda a_fit: a_fit[0])
+				
+			
+	def log_loading_finish(self, memory, thing, error):
+		if not thing.lists:
+			pass # Only things in albums are logged
+			
+		elif error:
 			notification.log(notification.Lines.Error(error))
 			
 		elif thing.on_memory:
@@ -279,65 +514,127 @@ class ImageViewer(Gtk.Application):
 	
 	def open_files_for_album(self, album, loader=None, files=None, uris=None,
 	                         replace=False, search=False, silent=False,
-	                         manage=True):
-		''' Open files or uris for an album '''
+	                         manage=True, callback=None,
+	                         progress_callback=None):
+		''' Open files or uris for an album.
+		    The files are opened asynchronously and images are added to the
+		    album as they are found, callback is called with no arguments
+		    after all images are added to the album. Returns a FileOpening '''
 		album_context = loading.Context(files=files, uris=uris)
-		context_sorting = lambda ctx: album.sort_list(ctx.images)
-		
-		self.open_files(album_context, context_sorting=context_sorting,
-		                loader=loader, search=search, silent=silent)
-		
-		if album_context.images:
-			if replace:
-				del album[:]
-			
-			if manage:			
-				for image in album_context.images:
-					self.memory.observe(image)
+		if replace:
+			self.unwatch_album(album)
+			
+		directory_callback = None
+		if self.watch_directories:
+			directory_callback = lambda gfile, loader: \
+			                     self.watch_directory(album, gfile, loader)
+		
+		batches = []
+		def add_images(some_images):
+			if some_images:
+				if replace and not batches:
+					del album[:]
 					
-			album.extend(album_context.images)
+				if manage:
+					for image in some_images:
+						self.memory.observe(image)
+						
+				batches.append(some_images)
+				# Directory listings and siblings arrive in batches after
+				# the first image is shown. Into sorted albums they are
+				# inserted in order around it instead of sorting the album
+				# again, which would move everything around the image
+				self.add_album_images(album, some_images,
+				                      splice=replace or album.autosort)
+				
+		def finish(context):
+			if callback:
+				callback()
+				
+		return self.open_files(album_context, loader=loader, search=search,
+		                       silent=silent,
+		                       images_callback=add_images, callback=finish,
+		                       progress_callback=progress_callback,
+		                       directory_callback=directory_callback)
 		
 		
 	def open_files(self, context, loader=None, search=False,
-	                     context_sorting=None, silent=False):
+	                     context_sorting=None, silent=False,
+	                     images_callback=None, callback=None,
+	                     progress_callback=None, directory_callback=None):
 	                     
-		''' Open files using loading.LoadersLoader '''
+		''' Open files using loading.LoadersLoader.
+		    The files info is queried and directories are listed without
+		    blocking. images_callback(images) is called with every batch of
+		    images opened and callback(context) once everything is opened.
+		    Returns a FileOpening, see it for the rest '''
 		if loader is None:
 			loader = loading.LoadersLoader.LoaderListLoader
 		
 		context.uris_to_files()
-		context.load_files_info()
-		for a_file, a_problem in context.problems.items():
-			context.files.remove(a_file)
-		
-		directories = []
-		removed_files = 0
-		for i in range(len(context.files)):
-			index = i - removed_files
-			a_file = context.files[index]
+		opening = FileOpening(self, context, loader, search, context_sorting,
+		                      silent, images_callback, callback,
+		                      progress_callback, directory_callback)
+		opening.start()
+		return opening
+		
+		
+	def add_album_images(self, album, images, splice=True):
+		''' Adds images to an album. With splice they are inserted where
+		    they belong in the album order, see Album.splice, otherwise
+		    they are sorted among themselves and appended. If the album is
+		    sorted by metadata the images are added once it's probed '''
+		def place_images(*data):
+			if splice:
+				album.splice(images)
+				
+			else:
+				album.sort_list(images)
+				album.extend(images)
+				
+		missing = [an_image for an_image in images if an_image.needs_metadata]
+		if album.comparer in organization.SortingKeys.Metadata and missing:
+			probing = loading.ProbeMetadata(missing)
+			probing.add_done_callback(place_images)
+			
+		else:
+			place_images()
+			
+	def watch_directory(self, album, gfile, loader):
+		''' Keeps the images of a directory in an album up to date '''
+		album_watches = self.directory_watches.setdefault(album, dict())
+		uri = gfile.get_uri()
+		if uri not in album_watches:
 			try:
-				if DirectoryLoader.should_open(a_file):
-					removed_files += 1
-					directories.append(a_file)
-					del context.files[index]
-			except Exception:
-				raise
+				album_watches[uri] = DirectoryWatch(self, album, gfile, loader)
+				
+			except GLib.Error:
+				pass # Not every location can be monitored
+				
+	def unwatch_album(self, album):
+		''' Stops watching the directories opened in an album '''
+		for a_watch in self.directory_watches.pop(album, dict()).values():
+			a_watch.stop()
+		
 		
-		if search and context.files:
-			# Sibling file loading is not sorted
-			context.add_sibling_files(loader)
-			files = list(context.files)
-			del context.files[:]
-			self.open_context_images(context, files, loader)
-			                         
-		if directories:
-			self.open_context_images(context, directories, DirectoryLoader,
-			                         sort_method=context_sorting)
-			                         
-		if context.files:
-			self.open_context_images(context, context.files, loader,
-			                         sort_method=context_sorting)
+	def _open_files_batch(self, context, some_files, loader, sort_method,
+	                      images_callback):
+		loader_context = loading.Context()
+		for a_file in some_files:
+			loader.open_file(loader_context, a_file)
+			
+		self._add_opened_batch(context, loader_context, sort_method,
+		                       images_callback)
 		
+	def _add_opened_batch(self, context, loader_context, sort_method,
+	                      images_callback):
+		start = len(context.images)
+		self.merge_context(context, loader_context, sort_method=sort_method)
+		if images_callback:
+			images_callback(context.images[start:])
+			
+			
+	def _finish_opening(self, context, silent, callback):
 		if context.problems and not silent:
 			problem_list = []
 			for a_file, a_problem in context.problems.items():
@@ -348,6 +645,9 @@ class ImageViewer(Gtk.Application):
 			
 			notification.alert_list(message, problem_list, columns)
 			
+		if callback:
+			callback(context)
+			
 			
 	def open_context_images(self, context, files, loader, sort_method=None):
 		''' Opens files in a loader, sort the result with sort_method and
@@ -356,18 +656,318 @@ class ImageViewer(Gtk.Application):
 		for a_file in files:
 			loader.open_file(loader_context, a_file)
 		
+		self.merge_context(context, loader_context, sort_method=sort_method)
+		
+	def merge_context(self, context, loader_context, sort_method=None):
+		''' Sorts the images of loader_context with sort_method and appends
+		    its images, files, uris and problems to context '''
 		if sort_method:
 			sort_method(loader_context)
 		
 		context.images.extend(loader_context.images)
 		context.files.extend(loader_context.files)
 		context.uris.extend(loader_context.uris)
+		context.problems.update(loader_context.problems)
 		
 	def load_pixels(self, pixels):
 		pixelated_image = loading.PixbufDataImageNode(pixels, "Pixels")
 		return [pixelated_image]
 	
 	
+class FileOpening:
+	''' Opens files for ImageViewer.open_files a chunk at a time.
+	    The first file is opened on its own so that it shows up right away,
+	    then as many as can be opened in TimeSlice seconds at a time, so
+	    the main loop keeps running while thousands of files are opened.
+	    progress_callback(opened, total) is called after every chunk with
+	    the number of files given that were opened, total is zero once
+	    only directory listings are left. directory_callback(gfile, loader)
+	    is called for every directory images are opened from. '''
+	TimeSlice = 0.008
+	MaxChunkSize = 512
+	
+	def __init__(self, app, context, loader, search, sorting, silent,
+	             images_callback, callback, progress_callback,
+	             directory_callback=None):
+		self.app = app
+		self.context = context
+		self.loader = loader
+		self.search = search
+		self.sorting = sorting
+		self.silent = silent
+		self.images_callback = images_callback
+		self.callback = callback
+		self.progress_callback = progress_callback
+		self.directory_callback = directory_callback
+		self.cancellable = Gio.Cancellable()
+		# Whether the callback was already called
+		self.done = False
+		
+		self.total = len(context.files)
+		self.opened = 0
+		self._files = collections.deque(context.files)
+		self._opened_files = []
+		self._chunk_size = 1
+		self._pending_listings = 0
+		# Tasks of the chunks whose loaders are still opening them
+		self._pending_chunks = set()
+		self._files_finished = False
+		
+	def start(self):
+		self._open_next_chunk()
+		
+	def cancel(self):
+		''' Stops opening files, the images already opened are kept '''
+		self.cancellable.cancel()
+		self._files.clear()
+		for an_opening in list(self._pending_chunks):
+			an_opening.cancel()
+			
+		self._finish()
+		
+	def _open_next_chunk(self):
+		if self._files:
+			chunk_size = min(self._chunk_size, len(self._files))
+			chunk = [self._files.popleft() for i in range(chunk_size)]
+			chunk_context = loading.Context(files=chunk)
+			chunk_context.load_files_info_async(self._open_chunk)
+			
+		elif not self._files_finished:
+			self._files_finished = True
+			if self.search and self._opened_files:
+				# Sibling file loading is not sorted
+				self._pending_listings += 1
+				sibling_context = loading.Context(files=self._opened_files)
+				sibling_context.add_sibling_files_async(self.loader,
+				                                        self._listed)
+				if self.directory_callback:
+					parents = dict()
+					for a_file in self._opened_files:
+						a_parent = a_file.get_parent()
+						if a_parent:
+							parents.setdefault(a_parent.get_uri(), a_parent)
+							
+					for a_parent in parents.values():
+						self.directory_callback(a_parent, self.loader)
+						
+				
+			self._check_finished()
+			
+		return False
+		
+	def _open_chunk(self, chunk_context):
+		if self.done:
+			return
+			
+		start_time = time.perf_counter()
+		self.context.problems.update(chunk_context.problems)
+		some_files = []
+		for a_file in chunk_context.files:
+			if a_file in chunk_context.problems:
+				continue
+				
+			if DirectoryLoader.should_open(a_file):
+				self._pending_listings += 1
+				DirectoryLoader.open_file_async(self.context, a_file,
+				                                self._listed_sorted,
+				                                self.cancellable)
+				if self.directory_callback:
+					self.directory_callback(a_file, self.loader)
+					
+			else:
+				some_files.append(a_file)
+				
+		# Loaders that open files without waiting are done by the time
+		# OpenFiles returns, the others add their images later
+		self._opened_files.extend(some_files)
+		opening = loading.OpenFiles(self.loader, loading.Context(),
+		                            some_files)
+		self._pending_chunks.add(opening)
+		opening.add_done_callback(self._chunk_opened)
+		
+		self.opened += len(chunk_context.files)
+		self._report_progress()
+		
+		# Fit the next chunk in the time slice
+		elapsed = max(time.perf_counter() - start_time, 0.0001)
+		chunk_size = int(self._chunk_size * FileOpening.TimeSlice / elapsed)
+		self._chunk_size = max(1, min(chunk_size, FileOpening.MaxChunkSize))
+		
+		# Let the main loop draw the opened images before the next chunk
+		GLib.idle_add(self._open_next_chunk)
+		
+	def _chunk_opened(self, opening):
+		self._pending_chunks.discard(opening)
+		if self.done:
+			return
+			
+		self.app._add_opened_batch(self.context, opening.result(),
+		                           self.sorting, self.images_callback)
+		self._check_finished()
+		
+	def _listed_sorted(self, listing_context, some_files, finished):
+		self._listed(listing_context, some_files, finished, self.sorting)
+		
+	def _listed(self, listing_context, some_files, finished, sorting=None):
+		if self.done:
+			return
+			
+		self.app._open_files_batch(self.context, some_files, self.loader,
+		                           sorting, self.images_callback)
+		if finished:
+			self._pending_listings -= 1
+			
+		self._report_progress()
+		self._check_finished()
+		
+	def _report_progress(self):
+		if self.progress_callback and not self.done:
+			self.progress_callback(self.opened,
+			                       self.total if self._files else 0)
+			                       
+	def _check_finished(self):
+		if self._files_finished and not self._pending_listings and \
+		   not self._pending_chunks:
+			self._finish()
+			
+	def _finish(self):
+		if not self.done:
+			self.done = True
+			self.app._finish_opening(self.context, self.silent,
+			                         self.callback)
+			
+class DirectoryWatch:
+	''' Keeps the images of a directory in an album up to date with a
+	    Gio.FileMonitor. Events are coalesced until none arrived for
+	    CoalesceDelay seconds, then new files are inserted next to their
+	    siblings, deleted files are removed and only the images of
+	    changed files are loaded again '''
+	CoalesceDelay = 0.3
+	
+	Removed = "removed"
+	Updated = "updated"
+	
+	def __init__(self, app, album, gfile, loader):
+		self.app = app
+		self.album = album
+		self.gfile = gfile
+		self.loader = loader
+		# Maps uris to the latest of Removed or Updated and their files
+		self._events = collections.OrderedDict()
+		self._apply_source = None
+		
+		self.monitor = gfile.monitor_directory(
+		                   Gio.FileMonitorFlags.WATCH_MOVES, None)
+		self.monitor.connect("changed", self._changed)
+		
+	def stop(self):
+		self.monitor.cancel()
+		if self._apply_source is not None:
+			GLib.source_remove(self._apply_source)
+			self._apply_source = None
+			
+		self._events.clear()
+		
+	def _changed(self, monitor, a_file, other_file, event):
+		Event = Gio.FileMonitorEvent
+		if event in (Event.DELETED, Event.MOVED_OUT):
+			self._add_event(a_file, DirectoryWatch.Removed)
+			
+		elif event in (Event.CREATED, Event.CHANGED,
+		               Event.CHANGES_DONE_HINT, Event.MOVED_IN):
+			# Files being written send a CHANGED for every write, each of
+			# them puts off reloading the image until writing is done
+			self._add_event(a_file, DirectoryWatch.Updated)
+			
+		elif event == Event.RENAMED:
+			self._add_event(a_file, DirectoryWatch.Removed)
+			self._add_event(other_file, DirectoryWatch.Updated)
+			
+	def _add_event(self, a_file, kind):
+		uri = a_file.get_uri()
+		self._events.pop(uri, None)
+		self._events[uri] = kind, a_file
+		
+		# Wait for things to settle, files are usually written in steps
+		if self._apply_source is not None:
+			GLib.source_remove(self._apply_source)
+			
+		self._apply_source = GLib.timeout_add(
+		                         int(DirectoryWatch.CoalesceDelay * 1000),
+		                         self._apply_events)
+		
+	def _apply_events(self):
+		self._apply_source = None
+		events, self._events = self._events, collections.OrderedDict()
+		
+		images_by_uri = dict()
+		for an_image in self.album:
+			a_file = getattr(an_image, "gfile", None)
+			if a_file is not None:
+				images_by_uri.setdefault(a_file.get_uri(), []).append(an_image)
+				
+		new_files = []
+		changed = False
+		for uri, (kind, a_file) in events.items():
+			some_images = images_by_uri.get(uri, [])
+			if kind == DirectoryWatch.Removed:
+				for an_image in some_images:
+					self.album.remove(an_image)
+					
+			elif some_images:
+				changed = True
+				for an_image in some_images:
+					self._invalidate(an_image)
+					
+			else:
+				new_files.append(a_file)
+				
+		if changed:
+			# Changed files can have a different size and date
+			self.album.forget_keys()
+			if self.album.autosort:
+				self.album.sort()
+				
+		if new_files:
+			context = loading.Context()
+			self.app.open_context_images(context, new_files, self.loader)
+			for an_image in context.images:
+				self.app.memory.observe(an_image)
+				
+			if self.album.comparer:
+				self.app.add_album_images(self.album, context.images)
+				
+			else:
+				# Unsorted images go after the images of the directory
+				position = self._find_position()
+				for an_image in context.images:
+					self.album.insert(position, an_image)
+					position += 1
+					
+		return False
+		
+	def _invalidate(self, image):
+		# Loads the image again if it's in use, otherwise it is
+		# loaded from the changed file whenever it's needed
+		image.metadata = None
+		memory = self.app.memory
+		preview = getattr(image, "preview", None)
+		if preview is not None:
+			memory.unload(preview)
+			
+		if (memory.unload(image) or image.is_bad) and image.uses:
+			memory.requested_stuff.add(image)
+			self.app.queue_memory_check()
+			
+	def _find_position(self):
+		# Returns the index after the last image of the directory
+		for i in range(len(self.album) - 1, -1, -1):
+			a_file = getattr(self.album[i], "gfile", None)
+			if a_file is not None and a_file.has_parent(self.gfile):
+				return i + 1
+				
+		return len(self.album)
+		
 class ViewerWindow(Gtk.ApplicationWindow):
 	def __init__(self, app):
 		Gtk.ApplicationWindow.__init__(
@@ -379,6 +979,7 @@ class ViewerWindow(Gtk.ApplicationWindow):
 		# Idly refresh index
 		self._refresh_index = utility.IdlyMethod(self._refresh_index)
 		self._refresh_transform = utility.IdlyMethod(self._refresh_transform)
+		self._refresh_decoding = utility.IdlyMethod(self._refresh_decoding)
 		
 		# Auto zoom stuff
 		self.auto_zoom_magnify = False
@@ -395,10 +996,13 @@ class ViewerWindow(Gtk.ApplicationWindow):
 		self._focus_loaded_handler_id = None
 		self._old_focused_image = None
 		self.go_new = False
+		# FileOpenings that are still running
+		self._openings = []
 		self.album = organization.Album()
 		self.album.connect("image-added", self._image_added)
 		self.album.connect("image-removed", self._image_removed)
 		self.album.connect("order-changed", self._album_order_changed)
+		self.album.connect("sort-progress", self._sort_progressed)
 		
 		# Set clipboard
 		self.clipboard = Gtk.Clipboard.get(Gdk.SELECTION_CLIPBOARD)
@@ -467,6 +1071,19 @@ class ViewerWindow(Gtk.ApplicationWindow):
 		self.loading_spinner = Gtk.Spinner()
 		self.statusbarbox.pack_start(self.loading_spinner, False, True, 0)
 		
+		# And a progress bar for opening files, which can be stopped
+		self.opening_progress = Gtk.ProgressBar()
+		self.opening_progress.set_valign(Gtk.Align.CENTER)
+		self.statusbarbox.pack_start(self.opening_progress, False, True, 0)
+		
+		self.opening_stop_button = Gtk.Button.new_from_icon_name(
+		                               "process-stop", Gtk.IconSize.MENU)
+		self.opening_stop_button.set_relief(Gtk.ReliefStyle.NONE)
+		self.opening_stop_button.set_tooltip_text(_("Stop opening files"))
+		self.opening_stop_button.connect("clicked", self.stop_opening)
+		self.statusbarbox.pack_start(self.opening_stop_button,
+		                             False, True, 0)
+		
 		self.statusbar = Gtk.Statusbar()
 		self.statusbarbox.pack_start(self.statusbar, True, True, 0)
 		
@@ -497,6 +1114,8 @@ class ViewerWindow(Gtk.ApplicationWindow):
 		
 		self.statusbarboxbox.show_all()
 		self.loading_spinner.hide()
+		self.opening_progress.hide()
+		self.opening_stop_button.hide()
 		
 		# DnD setup	
 		self.view.drag_dest_set(
@@ -1080,6 +1699,7 @@ class ViewerWindow(Gtk.ApplicationWindow):
 	
 	def magnification_changed(self, widget, data=None):
 		self.auto_zoom_zoom_modified = True
+		self._refresh_decoding.queue()
 		
 	def view_changed(self, widget, data):
 		self._refresh_transform.queue()
@@ -1087,6 +1707,27 @@ class ViewerWindow(Gtk.ApplicationWindow):
 	def reapply_auto_zoom(self, *data):
 		if self.auto_zoom_enabled and not self.auto_zoom_zoom_modified:
 			self.auto_zoom()
+			
+	def get_decoding_fit(self):
+		''' Returns the view size and zoom mode images are decoded for
+		    or None if they should be decoded at their actual size '''
+		if self.auto_zoom_enabled and self.auto_zoom_minify:
+			return self.view.get_widget_size(), self.auto_zoom_mode
+			
+		else:
+			return None
+			
+	def _refresh_decoding(self):
+		''' Loads the focused image again at its actual size
+		    if it is magnified past the size it was decoded at '''
+		focused_image = self.avl.focus_image
+		if focused_image and focused_image.on_memory and \
+		   not focused_image.is_loading and \
+		   getattr(focused_image, "fit", None) is not None:
+			if self.view.magnification > focused_image.decoded_scale:
+				focused_image.fit = None
+				focused_image.load()
+				notification.log(notification.Lines.Loading(focused_image))
 
 		
 	def _refresh_index(self):
@@ -1386,7 +2027,7 @@ class ViewerWindow(Gtk.ApplicationWindow):
 		some_uris = self.clipboard.wait_for_uris()
 		
 		if some_uris:
-			self.app.open_files_for_album(self.album, uris=some_uris)
+			self.open_files(uris=some_uris)
 			
 		some_pixels = self.clipboard.wait_for_image()
 		if some_pixels:
@@ -1394,17 +2035,18 @@ class ViewerWindow(Gtk.ApplicationWindow):
 			if new_images:
 				self.album.extend(new_images)
 				
-		self.go_new = False
+		if not some_uris:
+			self.go_new = False
 			
 	def dragged_data(self, widget, context, x, y, selection, info, timestamp):
 		self.go_new = True
 		if info == DND_URI_LIST:
 			some_uris = selection.get_uris()
 			if some_uris:
-				self.app.open_files_for_album(self.album, uris=some_uris,
-				                                   search=len(some_uris) == 1,
-				                                   replace=True)
-				                                   
+				self.open_files(uris=some_uris, search=len(some_uris) == 1,
+				                replace=True)
+				return
+				
 		elif info == DND_IMAGE:
 			some_pixels = selection.get_pixbuf()
 			if some_pixels:
@@ -1413,6 +2055,63 @@ class ViewerWindow(Gtk.ApplicationWindow):
 					self.album.extend(new_images)
 					
 		self.go_new = False
+	
+	def open_files(self, files=None, uris=None, search=False, replace=False):
+		''' Opens files into the album, going to the new images
+		    and showing the progress in the statusbar '''
+		self.go_new = True
+		opening = self.app.open_files_for_album(
+		              self.album, files=files, uris=uris, search=search,
+		              replace=replace, callback=self.finished_opening,
+		              progress_callback=self._opening_progressed)
+		              
+		if not opening.done:
+			self._openings.append(opening)
+			self.opening_progress.set_fraction(0)
+			self.opening_progress.show()
+			self.opening_stop_button.show()
+			
+	def _opening_progressed(self, opened, total):
+		if total:
+			self.opening_progress.set_fraction(opened / total)
+			
+		else:
+			# Nobody knows how many files directories have
+			self.opening_progress.pulse()
+			
+	def _sort_progressed(self, album, probed, total):
+		if probed < total:
+			if not self._openings:
+				self.opening_progress.set_fraction(probed / total)
+				
+			self.opening_progress.show()
+			self.opening_stop_button.show()
+			
+		elif not self._openings:
+			self.opening_progress.hide()
+			self.opening_stop_button.hide()
+			
+	def stop_opening(self, *data):
+		''' Stops opening files, keeping the images already opened,
+		    and probing metadata for sorting the album '''
+		for an_opening in list(self._openings):
+			an_opening.cancel()
+			
+		self.album.stop_sorting()
+		self._hide_opening_progress()
+		
+	def finished_opening(self):
+		''' Stops going to new images after files were opened '''
+		self._openings = [an_opening for an_opening in self._openings
+		                             if not an_opening.done]
+		if not self._openings:
+			self.go_new = False
+			self._hide_opening_progress()
+			
+	def _hide_opening_progress(self):
+		if not self._openings and not self.album.sorting:
+			self.opening_progress.hide()
+			self.opening_stop_button.hide()
 								
 	def file_open(self, widget, data=None):
 		self.app.open_image_dialog(self.album, self)
@@ -1499,6 +2198,7 @@ class ViewerWindow(Gtk.ApplicationWindow):
 		
 		# Clean up the avl
 		self.avl.clean()
+		self.app.unwatch_album(self.album)
 		return Gtk.Window.do_destroy(self)
 		
 	
@@ -1531,6 +2231,9 @@ class ViewerWindow(Gtk.ApplicationWindow):
 		
 		self._refresh_index.queue()
 		self.refresh_title(focused_image)
+		# Loads are ranked by the distance from the focus
+		self.app.queue_memory_check()
+		self._refresh_decoding.queue()
 		
 		loading_ctx = self.statusbar.get_context_id("loading")
 		self.statusbar.pop(loading_ctx)
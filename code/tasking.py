@@ -0,0 +1,249 @@
+''' tasking.py runs coroutines in the GLib main loop, so that code that
+    waits for GIO operations, worker threads or signals can be written
+    top to bottom instead of being split across callbacks. '''
+
+''' ...and this file is part of Pynorama.
+    
+    Pynorama is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    
+    Pynorama is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU General Public License for more details.
+    
+    You should have received a copy of the GNU General Public License
+    along with Pynorama. If not, see <http://www.gnu.org/licenses/>. '''
+
+import sys, traceback
+from gi.repository import Gio, GLib, GObject
+
+class Cancelled(Exception):
+	''' Raised by futures and tasks that were cancelled '''
+	pass
+
+class Future:
+	''' The result of something that finishes later in the main loop.
+	    Coroutines wait for it with "yield from future", or with
+	    "await future" in native coroutines. Callbacks added with
+	    add_done_callback are called with the future once it's done,
+	    right away if it's already done '''
+	
+	def __init__(self, cancellable=None):
+		self.cancellable = cancellable or Gio.Cancellable()
+		self._done = False
+		self._result = None
+		self._error = None
+		self._callbacks = []
+		
+	def done(self):
+		return self._done
+		
+	def result(self):
+		''' Returns the result or raises the error of a done future '''
+		if not self._done:
+			raise Exception("The future is not done yet")
+			
+		if self._error is not None:
+			raise self._error
+			
+		return self._result
+		
+	def error(self):
+		''' Returns the error of a done future or None '''
+		return self._error
+		
+	def set_result(self, result):
+		''' Finishes the future, it is ignored if it was already done '''
+		if not self._done:
+			self._result = result
+			self._finish()
+			
+	def set_error(self, error):
+		''' Fails the future, it is ignored if it was already done '''
+		if not self._done:
+			self._error = error
+			self._finish()
+			
+	def cancel(self):
+		''' Cancels the cancellable of the future and fails it '''
+		if not self._done:
+			self.cancellable.cancel()
+			self.set_error(Cancelled())
+			
+	def add_done_callback(self, callback):
+		if self._done:
+			callback(self)
+			
+		else:
+			self._callbacks.append(callback)
+			
+	def _finish(self):
+		self._done = True
+		callbacks, self._callbacks = self._callbacks, []
+		for a_callback in callbacks:
+			a_callback(self)
+			
+	def __iter__(self):
+		if not self._done:
+			yield self
+			
+		return self.result()
+		
+	__await__ = __iter__
+
+class Task(Future):
+	''' Runs a coroutine in the main loop, its result is what the coroutine
+	    returns. The coroutine can be a generator that waits for futures
+	    with "yield from" or a native coroutine. It runs right away until
+	    it has to wait, so coroutines that never wait finish in the
+	    constructor. A bare "yield" lets the main loop run for a while.
+	    Cancelling a task raises Cancelled in the coroutine. Errors that
+	    nobody waits for are printed '''
+	
+	def __init__(self, coroutine, cancellable=None):
+		Future.__init__(self, cancellable)
+		self._coroutine = coroutine
+		self._waiting = None
+		self._cancel_raised = False
+		self._step()
+		
+	def cancel(self):
+		if self._done:
+			return
+			
+		self.cancellable.cancel()
+		if self._waiting is not None:
+			# Wakes this up with the Cancelled error
+			self._waiting.cancel()
+			
+	def _step(self, error=None):
+		while True:
+			if error is None and not self._cancel_raised and \
+			   self.cancellable.is_cancelled():
+				self._cancel_raised = True
+				error = Cancelled()
+				
+			try:
+				if error is None:
+					yielded = self._coroutine.send(None)
+					
+				else:
+					yielded = self._coroutine.throw(error)
+					
+			except StopIteration as stop:
+				self.set_result(stop.value)
+				return
+				
+			except Exception as a_problem:
+				if not self._callbacks and \
+				   not isinstance(a_problem, Cancelled):
+					traceback.print_exception(type(a_problem), a_problem,
+					                          a_problem.__traceback__,
+					                          file=sys.stderr)
+				self.set_error(a_problem)
+				return
+				
+			error = None
+			if yielded is None:
+				GLib.idle_add(self._resume)
+				return
+				
+			elif not isinstance(yielded, Future):
+				error = TypeError("Tasks can only wait for futures")
+				
+			elif not yielded.done():
+				self._waiting = yielded
+				yielded.add_done_callback(self._wake_up)
+				return
+				
+	def _wake_up(self, future):
+		# The future result is taken by Future.__iter__ in the coroutine
+		self._waiting = None
+		self._step()
+		
+	def _resume(self):
+		self._step()
+		return False
+
+def Ensure(awaitable):
+	''' Returns a future for a future or a coroutine, starting a task
+	    for coroutines '''
+	if isinstance(awaitable, Future):
+		return awaitable
+		
+	elif hasattr(awaitable, "send") and hasattr(awaitable, "throw"):
+		return Task(awaitable)
+		
+	else:
+		raise TypeError("{} can't be awaited".format(awaitable))
+
+def Wrap(start, finish, *args, cancellable=None):
+	''' Starts a GIO style asynchronous operation and returns a future for
+	    its result. start is called with args followed by a cancellable,
+	    a callback and user data, and finish with the GAsyncResult. E.g.
+	    Wrap(gfile.read_async, gfile.read_finish, GLib.PRIORITY_DEFAULT) '''
+	future = Future(cancellable)
+	def finished(source, result, *data):
+		try:
+			value = finish(result)
+			
+		except Exception as a_problem:
+			future.set_error(a_problem)
+			
+		else:
+			future.set_result(value)
+			
+	start(*args + (future.cancellable, finished, None))
+	return future
+
+def Gather(*awaitables, return_errors=False):
+	''' Returns a future for the results of several futures or coroutines,
+	    in the same order, which all run at the same time. It fails with
+	    the first error unless return_errors is true, in which case errors
+	    are put in the results instead. Cancelling it cancels them all '''
+	futures = [Ensure(an_awaitable) for an_awaitable in awaitables]
+	gathered = Future()
+	pending = [len(futures)]
+	def cancelled(*data):
+		# Fails first so the futures cancelled next don't finish it
+		gathered.set_error(Cancelled())
+		for a_future in futures:
+			a_future.cancel()
+			
+	def future_done(a_future):
+		if gathered.done():
+			return
+			
+		elif a_future.error() is not None and not return_errors:
+			gathered.set_error(a_future.error())
+			
+		else:
+			pending[0] -= 1
+			if not pending[0]:
+				gathered.set_result([a_future.error() or a_future._result
+				                     for a_future in futures])
+				
+	if futures:
+		for a_future in futures:
+			a_future.add_done_callback(future_done)
+			
+		# Gio.Cancellable.connect is not the signal connect
+		GObject.Object.connect(gathered.cancellable, "cancelled", cancelled)
+		
+	else:
+		gathered.set_result([])
+		
+	return gathered
+
+def Sleep(seconds):
+	''' Returns a future that is done after some seconds '''
+	future = Future()
+	def timeout():
+		future.set_result(None)
+		return False
+		
+	GLib.timeout_add(int(seconds * 1000), timeout)
+	return future
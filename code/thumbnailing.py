@@ -0,0 +1,116 @@
+''' thumbnailing.py reads and writes thumbnails in the thumbnail cache
+    shared with other desktop applications, as described by
+    the freedesktop.org thumbnail managing standard. '''
+
+''' ...and this file is part of Pynorama.
+    
+    Pynorama is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    
+    Pynorama is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU General Public License for more details.
+    
+    You should have received a copy of the GNU General Public License
+    along with Pynorama. If not, see <http://www.gnu.org/licenses/>. '''
+
+import hashlib, os, tempfile
+from gi.repository import GdkPixbuf, GLib
+
+class Size:
+	''' Names of the thumbnail sizes and their maximum side length '''
+	Normal = "normal"
+	Large = "large"
+	ExtraLarge = "x-large"
+	
+	Pixels = {
+		Normal: 128,
+		Large: 256,
+		ExtraLarge: 512
+	}
+	
+	Enum = [Normal, Large, ExtraLarge]
+
+def GetDirectory(size):
+	''' Returns the directory where thumbnails of a size are stored '''
+	return os.path.join(GLib.get_user_cache_dir(), "thumbnails", size)
+
+def GetPath(uri, size):
+	''' Returns the path of the thumbnail of an uri '''
+	name = hashlib.md5(uri.encode("utf-8")).hexdigest() + ".png"
+	return os.path.join(GetDirectory(size), name)
+
+def Load(uri, mtime, size):
+	''' Loads a thumbnail for an uri that is up to date with its mtime.
+	    Thumbnails of the other sizes are tried if there is none of this size.
+	    Returns the thumbnail pixbuf and the size of the image it was made
+	    from, which is None if it is not known, or (None, None) '''
+	sizes = [size] + [a_size for a_size in Size.Enum if a_size != size]
+	for a_size in sizes:
+		try:
+			pixbuf = GdkPixbuf.Pixbuf.new_from_file(GetPath(uri, a_size))
+			
+		except GLib.GError:
+			continue
+			
+		# Thumbnails of modified or other images are stale
+		if pixbuf.get_option("tEXt::Thumb::URI") != uri:
+			continue
+			
+		if pixbuf.get_option("tEXt::Thumb::MTime") != str(int(mtime)):
+			continue
+			
+		try:
+			image_size = (int(pixbuf.get_option("tEXt::Thumb::Image::Width")),
+			              int(pixbuf.get_option("tEXt::Thumb::Image::Height")))
+			
+		except (TypeError, ValueError):
+			image_size = None
+			
+		return pixbuf, image_size
+		
+	return None, None
+
+def Create(pixbuf, image_size, size):
+	''' Scales down a pixbuf to a thumbnail size, returns None if the
+	    image is not bigger than the thumbnail or the pixbuf was decoded
+	    smaller than the thumbnail, which would make it blurry '''
+	pixels = Size.Pixels[size]
+	width, height = image_size
+	if width <= pixels and height <= pixels:
+		return None
+		
+	if max(pixbuf.get_width(), pixbuf.get_height()) < pixels:
+		return None
+		
+	scale = pixels / max(width, height)
+	return pixbuf.scale_simple(max(1, round(width * scale)),
+	                           max(1, round(height * scale)),
+	                           GdkPixbuf.InterpType.BILINEAR)
+
+def Save(thumbnail, uri, mtime, image_size, size):
+	''' Stores a thumbnail for an uri in the cache.
+	    It is written to a temporary file first so that other applications
+	    never read a thumbnail that is only partially written '''
+	directory = GetDirectory(size)
+	os.makedirs(directory, mode=0o700, exist_ok=True)
+	
+	keys = ["tEXt::Thumb::URI", "tEXt::Thumb::MTime",
+	        "tEXt::Thumb::Image::Width", "tEXt::Thumb::Image::Height",
+	        "tEXt::Software"]
+	values = [uri, str(int(mtime)), str(image_size[0]), str(image_size[1]),
+	          "Pynorama"]
+	
+	handle, temp_path = tempfile.mkstemp(suffix=".png", dir=directory)
+	os.close(handle)
+	try:
+		thumbnail.savev(temp_path, "png", keys, values)
+		os.chmod(temp_path, 0o600)
+		os.replace(temp_path, GetPath(uri, size))
+		
+	except Exception:
+		os.remove(temp_path)
+		raise
@@ -15,8 +15,42 @@
     You should have received a copy of the GNU General Public License
     along with Pynorama. If not, see <http://www.gnu.org/licenses/>. '''
 
+import sys, time
 from gi.repository import GLib
 
+class StartupProfile:
+	''' Measures how long each phase of starting up takes '''
+	def __init__(self, start_time):
+		# Whether the profile should be reported
+		self.enabled = False
+		# Whether phases are no longer measured
+		self.finished = False
+		self.phases = []
+		self._start_time = self._last_time = start_time
+		
+	def mark(self, phase):
+		''' Ends a phase, which started when the previous one ended.
+		    Does nothing once the profile is finished '''
+		if self.finished:
+			return
+			
+		now = time.perf_counter()
+		self.phases.append((phase, now - self._last_time))
+		self._last_time = now
+		
+	def report(self, output=sys.stderr):
+		''' Prints the duration of every phase '''
+		for a_phase, a_duration in self.phases:
+			print("{:8.1f} ms  {}".format(a_duration * 1000, a_phase),
+			      file=output)
+			
+		total = self._last_time - self._start_time
+		print("{:8.1f} ms  Total".format(total * 1000), file=output)
+		
+	def finish(self):
+		''' Stops measuring phases '''
+		self.finished = True
+
 class IdlyMethod:
 	''' Manages a simple idle callback signal in GLib '''
 	def __init__(self, callback, *args, **kwargs):
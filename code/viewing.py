@@ -15,11 +15,17 @@
     You should have received a copy of the GNU General Public License
     along with Pynorama. If not, see <http://www.gnu.org/licenses/>. '''
 
-import math
+import math, sys
 from gi.repository import Gdk, GdkPixbuf, GLib, GObject, Gtk
 import point, utility
 import cairo
 
+try:
+	import numpy
+	
+except ImportError:
+	numpy = None
+
 class ZoomMode:
 	FillView = 0
 	MatchWidth = 1
@@ -150,43 +156,7 @@ class ImageView(Gtk.DrawingArea, Gtk.Scrollable):
 	
 	def zoom_for_size(self, size, mode):
 		''' Gets a zoom for a size based on a zoom mode '''
-		w, h = self.get_widget_size()
-		sw, sh = size
-		
-		if mode == ZoomMode.MatchWidth:
-			# Match view and size width
-			size_side = sw
-			view_side = w
-		
-		elif mode == ZoomMode.MatchHeight:
-			# Match view and size height
-			size_side = sh
-			view_side = h
-		else:
-			wr, hr = w / sw, h / sh
-			
-			if mode == ZoomMode.FitContent:
-				# Fit size inside view
-				if wr < hr:
-					size_side = sw
-					view_side = w
-				else:
-					size_side = sh
-					view_side = h
-										
-			elif mode == ZoomMode.FillView:
-				# Overflow size in view in only one side
-				if wr > hr:
-					size_side = sw
-					view_side = w
-				else:
-					size_side = sh
-					view_side = h
-			
-			else:
-				size_side = view_size = 1
-				
-		return view_side / size_side
+		return ZoomForSize(self.get_widget_size(), size, mode)
 		
 	def adjust_to_pin(self, pin):
 		''' Adjusts the view so that the same widget point in the pin can be
@@ -710,86 +680,190 @@ class ImageFrame(GObject.GObject):
 	origin = GObject.property(type=GObject.TYPE_PYOBJECT)
 	
 class ImageSurfaceFrame(ImageFrame):
-	def __init__(self, surface):
+	''' A frame for a cairo surface.
+	    If image_size is set the surface is stretched to fill it, that is
+	    used for showing images that were decoded at a smaller size '''
+	def __init__(self, surface, image_size=None):
 		ImageFrame.__init__(self)
+		self._views = set()
 		self.connect("notify::surface", self._surface_changed)
+		self.image_size = image_size
 		self.surface = surface
 	
+	def added(self, view):
+		self._views.add(view)
+		
+	def removed(self, view):
+		self._views.discard(view)
+	
 	def draw(self, cr, drawstate):
 		if self.surface:
 			offset = point.multiply(self.size, (-.5, -.5))
-			cr.set_source_surface(self.surface, *offset)
+			cr.translate(*offset)
+			
+			scale = self.get_surface_scale()
+			if scale != 1:
+				cr.scale(1 / scale, 1 / scale)
+				
+			cr.set_source_surface(self.surface, 0, 0)
 			
 			# Set filter
 			a_pattern = cr.get_source()
-			zoom = drawstate.magnification
+			zoom = drawstate.magnification / scale
 			a_filter = drawstate.get_filter_for_magnification(zoom)
 			if a_filter is not None:
 				a_pattern.set_filter(a_filter)
 		
 			cr.paint()
 			
+	def get_surface_scale(self):
+		''' Returns the size of the surface relative to the frame size '''
+		if self.surface and self.size[0]:
+			return self.surface.get_width() / self.size[0]
+			
+		else:
+			return 1
+			
 	surface = GObject.property(type=GObject.TYPE_PYOBJECT)
 	def _surface_changed(self, *args):
 		if self.surface:
-			w, h = self.surface.get_width(), self.surface.get_height()
+			w, h = self.image_size or (self.surface.get_width(),
+			                           self.surface.get_height())
 			self.rectangle = point.Rectangle(-w/2, -h/2, w, h)
 			self.size = w, h
 		else:
 			self.size = 0, 0
 			self.rectangle = point.Rectangle()
 			
-class AnimatedPixbufFrame(ImageFrame):
+		# Frames get their surface replaced by better quality ones
+		self.redraw()
+		
+	def redraw(self):
+		''' Redraws the frame in its views, for when something was drawn
+		    on its surface, e.g. rows of an image that is being decoded '''
+		for a_view in self._views:
+			a_view.queue_draw()
+			
+class AnimationPlayer:
+	''' Plays a pixbuf animation on a timeline shared by all
+	    the frames showing it. Animation frames are converted to cairo
+	    surfaces once and kept for the next loops while they fit in
+	    CacheLimit bytes, the rest are converted again every time.
+	    Animations whose loader draws every frame on the same pixbuf
+	    are converted every time '''
+	CacheLimit = 64 * 1024 * 1024
+	
 	def __init__(self, animation):
+		self.animation = animation
+		self.surface = None
+		self._frames = set()
+		self._iter = None
+		self._handle = None
+		# Microseconds into the animation, in steps of the frame delays
+		self._time = 0
+		# Surfaces by the pixbuf of the frame they were converted from
+		self._surfaces = {}
+		self._cache_size = 0
+		# Loaders that draw every frame on the same pixbuf can't be cached
+		self._cacheable = True
+		self._last_pixbuf = None
+		
+	def attach(self, frame):
+		''' Starts playing for a frame if it's not playing already '''
+		self._frames.add(frame)
+		if self._iter is None:
+			self._iter = self.animation.get_iter(self._get_time_val())
+			self._update_surface()
+			
+		if self._handle is None:
+			self._schedule_advance()
+			
+	def detach(self, frame):
+		''' Pauses the animation once no frame shows it '''
+		self._frames.discard(frame)
+		if not self._frames and self._handle:
+			GLib.source_remove(self._handle)
+			self._handle = None
+			
+	def get_memory_size(self):
+		''' Returns the bytes used by the cached surfaces '''
+		return self._cache_size
+		
+	def _get_time_val(self):
+		time_val = GLib.TimeVal()
+		time_val.tv_sec, time_val.tv_usec = divmod(self._time, 1000000)
+		return time_val
+		
+	def _schedule_advance(self):
+		delay = self._iter.get_delay_time()
+		if delay != -1:
+			self._handle = GLib.timeout_add(delay, self._advance, delay)
+			
+	def _advance(self, delay):
+		# Advancing is cheap, getting the pixbuf of a frame is not
+		self._time += delay * 1000
+		self._iter.advance(self._get_time_val())
+		self._update_surface(advanced=True)
+		for a_frame in self._frames:
+			a_frame.redraw()
+			
+		self._schedule_advance()
+		return False
+		
+	def _update_surface(self, advanced=False):
+		# The iter returns the pixbuf kept for each frame of the animation,
+		# the keys of the cache hold on to them so they are never mixed up
+		pixbuf = self._iter.get_pixbuf()
+		if advanced and pixbuf is self._last_pixbuf:
+			# The next frame was drawn on the same pixbuf
+			self._cacheable = False
+			self._clear_cache()
+			
+		self._last_pixbuf = pixbuf
+		surface = self._surfaces.get(pixbuf)
+		if surface is None:
+			surface = SurfaceFromPixbuf(pixbuf)
+			surface_size = surface.get_stride() * surface.get_height()
+			if self._cacheable and \
+			   self._cache_size + surface_size <= self.CacheLimit:
+				self._surfaces[pixbuf] = surface
+				self._cache_size += surface_size
+				
+		self.surface = surface
+		
+	def _clear_cache(self):
+		self._surfaces.clear()
+		self._cache_size = 0
+		
+class AnimatedPixbufFrame(ImageFrame):
+	''' A frame for a pixbuf animation. Frames created with the same
+	    player show the same animation frame at the same time '''
+	def __init__(self, animation, player=None):
 		ImageFrame.__init__(self)
+		self._views = set()
+		self.player = player or AnimationPlayer(animation)
 		self.connect("notify::animation", self._animation_changed)
 		self.animation = animation
-		self._view_anim = dict()
 	
 	def added(self, view):
-		anim_iter, anim_handle = self._view_anim.get(view, (None, None))
-		if anim_handle:
-			GLib.source_remove(anim_handle)
-			anim_handle = None
-		
-		try:
-			anim_iter = self.animation.get_iter(None)
-			self._view_anim[view] = anim_iter, anim_handle
-			self._schedule_advance(view)			
-			
-		except Exception:
-			self._view_anim[view] = anim_iter, anim_handle
+		self._views.add(view)
+		self.player.attach(self)
 	
 	def removed(self, view):
-		anim_iter, anim_handle = self._view_anim[view]
-		if anim_handle:
-			GLib.source_remove(anim_handle)
+		self._views.discard(view)
+		if not self._views:
+			self.player.detach(self)
 			
-		del self._view_anim[view]
-	
-	def _advance_animation(self, view):
-		anim_iter, anim_handle = self._view_anim[view]
-		anim_iter.advance(None)
-		self._view_anim[view] = anim_iter, None
-		
-		view.queue_draw()
-		
-		self._schedule_advance(view)
-		
-	def _schedule_advance(self, view):
-		anim_iter, anim_handle = self._view_anim[view]
-		delay = anim_iter.get_delay_time()
-		
-		if delay != -1:
-			anim_handle = GLib.timeout_add(delay, self._advance_animation, view)
-			self._view_anim[view] = anim_iter, anim_handle
+	def redraw(self):
+		''' Redraws the frame in its views '''
+		for a_view in self._views:
+			a_view.queue_draw()
 	
 	def draw(self, cr, drawstate):
-		anim_iter, anim_handle = self._view_anim[drawstate.view]
-		pixbuf = anim_iter.get_pixbuf()
-		if pixbuf:
+		surface = self.player.surface
+		if surface:
 			offset = point.multiply(self.size, (-.5, -.5))
-			Gdk.cairo_set_source_pixbuf(cr, pixbuf, *offset)
+			cr.set_source_surface(surface, *offset)
 			
 			# Set filter
 			a_pattern = cr.get_source()
@@ -810,8 +884,52 @@ class AnimatedPixbufFrame(ImageFrame):
 			self.rectangle = point.Rectangle()
 			self.size = 0, 0
 	
+def ZoomForSize(view_size, size, mode):
+	''' Gets a zoom for showing a size in a view based on a zoom mode '''
+	w, h = view_size
+	sw, sh = size
+	
+	if mode == ZoomMode.MatchWidth:
+		# Match view and size width
+		size_side = sw
+		view_side = w
+	
+	elif mode == ZoomMode.MatchHeight:
+		# Match view and size height
+		size_side = sh
+		view_side = h
+	else:
+		wr, hr = w / sw, h / sh
+		
+		if mode == ZoomMode.FitContent:
+			# Fit size inside view
+			if wr < hr:
+				size_side = sw
+				view_side = w
+			else:
+				size_side = sh
+				view_side = h
+									
+		elif mode == ZoomMode.FillView:
+			# Overflow size in view in only one side
+			if wr > hr:
+				size_side = sw
+				view_side = w
+			else:
+				size_side = sh
+				view_side = h
+		
+		else:
+			size_side = view_side = 1
+			
+	return view_side / size_side
+
 def SurfaceFromPixbuf(pixbuf):
-	''' Creates a cairo surface from a Gdk pixbuf'''
+	''' Creates a cairo surface from a Gdk pixbuf.
+	    This can be called from worker threads '''
+	if numpy is not None:
+		return _SurfaceFromPixelArray(pixbuf)
+		
 	surface = cairo.ImageSurface(cairo.FORMAT_ARGB32,
 		                         pixbuf.get_width(),
 		                         pixbuf.get_height())
@@ -820,3 +938,44 @@ def SurfaceFromPixbuf(pixbuf):
 	cr.paint()
 	
 	return surface
+
+# Indices of the red, green, blue and alpha bytes of ARGB32 pixels,
+# which are stored as native endian 32 bit integers
+if sys.byteorder == "little":
+	_ARGB32Order = 2, 1, 0, 3
+	
+else:
+	_ARGB32Order = 1, 2, 3, 0
+
+def _SurfaceFromPixelArray(pixbuf):
+	# Swizzles and premultiplies the pixbuf pixels with numpy straight into
+	# the surface data. Rows are converted in blocks to keep the temporary
+	# arrays small, numpy releases the GIL while it works on them
+	width, height = pixbuf.get_width(), pixbuf.get_height()
+	channels, rowstride = pixbuf.get_n_channels(), pixbuf.get_rowstride()
+	pixels = numpy.ndarray((height, width, channels), numpy.uint8,
+	                       buffer=pixbuf.get_pixels(),
+	                       strides=(rowstride, channels, 1))
+	                       
+	stride = cairo.ImageSurface.format_stride_for_width(cairo.FORMAT_ARGB32,
+	                                                    width)
+	data = numpy.empty((height, stride // 4, 4), numpy.uint8)
+	red, green, blue, alpha = _ARGB32Order
+	for top in range(0, height, 256):
+		source = pixels[top:top + 256]
+		target = data[top:top + 256, :width]
+		if channels == 4:
+			# Same rounding as cairo and Gdk, c * a / 255
+			colors = source[..., :3] * source[..., 3:].astype(numpy.uint16)
+			colors += 128
+			colors += colors >> 8
+			colors >>= 8
+			target[..., [red, green, blue]] = colors
+			target[..., alpha] = source[..., 3]
+			
+		else:
+			target[..., [red, green, blue]] = source[..., :3]
+			target[..., alpha] = 255
+			
+	return cairo.ImageSurface.create_for_data(data, cairo.FORMAT_ARGB32,
+	                                          width, height, stride)